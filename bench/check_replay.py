@@ -0,0 +1,71 @@
+"""Offline check of the replay entry point.
+
+Runs main() against the fake CTIS with some alerts already present in CTIS, so the state store
+keeps no objects for them, then replays every cached alert. Fails if the replay aborts, creates
+alerts or dossiers again, or queues relationships without an alert to point to.
+
+    python bench/check_replay.py
+"""
+import logging
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+from run_bench import load_bridge, write_config
+from fake_ctis import FakeCTIS
+from fake_rf import FakeConnectApiClient, make_alerts, ENTITY_TYPES
+
+def main():
+    ctis = FakeCTIS()
+    ctis_url = ctis.start()
+    alerts = make_alerts(6)
+    FakeConnectApiClient.serve(alerts)
+    # already in CTIS before the first run: processed without objects, like pruned or imported alerts
+    existing = alerts[:2]
+    ctis.insert("alerts", [{"title": a["title"].replace("\n", "") + " - " + a["id"]} for a in existing])
+
+    tmp = tempfile.mkdtemp(prefix="rf-ctis-replay-")
+    args = SimpleNamespace(types=",".join(ENTITY_TYPES), workers=2, batch_size=50)
+    write_config(f"{tmp}/config.yaml", ctis_url, args)
+    os.environ["RW_CONFIG_PATH"] = f"{tmp}/config.yaml"
+    os.environ["RW_FILES_PATH"] = tmp
+    logging.disable(logging.WARNING)
+
+    bridge = load_bridge()
+    bridge.main([])
+    dossiers = len(ctis.collections["x-dossiers"])
+    failures = []
+    for a in existing:
+        if bridge.state.objects(a["id"]):
+            failures.append(f"{a['id']} was already in CTIS but has stored objects")
+
+    try:
+        bridge.replay(["bridge", "replay"])
+    except Exception as e:
+        failures.append(f"replay aborted: {e!r}")
+
+    alert_ids = set(ctis.collections["alerts"])
+    if len(alert_ids) != len(alerts):
+        failures.append(f"{len(alert_ids)} alerts in CTIS after replay, expected {len(alerts)}")
+    # only the alerts without stored objects get new dossiers
+    expected = dossiers + sum(len(docs["documents"]) for a in existing for e in a["entities"] for docs in (e, e["entity"], e["risk"]))
+    if len(ctis.collections["x-dossiers"]) != expected:
+        failures.append(f"{len(ctis.collections['x-dossiers'])} dossiers after replay, expected {expected}")
+    relationships = ctis.collections["relationships"].values()
+    if any(r.get("source_ref") is None or r.get("target_ref") is None for r in relationships):
+        failures.append("relationships without a source or target were created")
+    linked = {r["source_ref"] for r in relationships if r.get("source_type") == "alerts"}
+    for a in existing:
+        ctis_id = bridge.state.db.execute("SELECT ctis_id FROM alerts WHERE alert_id = ?", (a["id"],)).fetchone()[0]
+        if ctis_id not in alert_ids or ctis_id not in linked:
+            failures.append(f"replayed {a['id']} is not linked to its existing CTIS alert")
+    ctis.stop()
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("Replay check passed" if not failures else f"{len(failures)} replay check failures")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import json
+import threading
+import urllib.parse
+import uuid
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# field CTIS deduplicates each collection on, anything not listed is keyed on "value"
+UNIQUE = {
+    "identities": "name",
+    "eeis": "name",
+    "alerts": "title",
+    "x-dossiers": None,
+    "settings": None
+}
+# gunicorn's default limit_request_line, the real server answers longer requests with an HTML 400
+MAX_REQUEST_LINE = 4094
+
+class FakeCTIS():
+    """Minimal Eve-style CTIS stand-in: bulk POST with 201/409, where/page GETs, PATCH and /login"""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.collections = {}
+        self.keys = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def key_of(self, coll, doc):
+        if coll == "relationships":
+            return (doc.get("source_ref"), doc.get("target_ref"), doc.get("relationship_type"), doc.get("sub-type"))
+        field = UNIQUE.get(coll, "value")
+        return doc.get(field) if field else None
+
+    def insert(self, coll, docs):
+        items = self.collections.setdefault(coll, {})
+        keys = self.keys.setdefault(coll, {})
+        with self.lock:
+            conflicts = [keys.get(self.key_of(coll, doc)) for doc in docs]
+            if any(conflicts):
+                if len(docs) == 1:
+                    return 409, {"_status": "ERR", "_id": conflicts[0], "_error": {"code": 409, "message": {"_id": conflicts[0]}}}
+                # like Eve, nothing is inserted and each document gets its own status
+                return 409, {"_status": "ERR", "_items": [
+                    {"_status": "ERR", "_error": {"code": 409, "message": {"_id": id}}} if id else {"_status": "OK"} for id in conflicts
+                ]}
+            created = []
+            for doc in docs:
+                id = uuid.uuid4().hex
+                doc = dict(doc, _id=id, _etag=uuid.uuid4().hex)
+                if coll == "identities":
+                    doc["aliases"] = [doc["name"]]
+                items[id] = doc
+                key = self.key_of(coll, doc)
+                if key is not None:
+                    keys[key] = id
+                created.append({"_id": id, "_etag": doc["_etag"], "_status": "OK"})
+        if len(created) == 1:
+            return 201, created[0]
+        return 201, {"_status": "OK", "_items": created}
+
+    def find(self, coll, where, page, max_results):
+        docs = self.collections.get(coll, {}).values()
+        if where:
+            docs = [d for d in docs if match(d, where)]
+        docs = list(docs)
+        chunk = docs[(page - 1) * max_results:page * max_results]
+        links = {"next": {"href": f"{coll}?page={page + 1}"}} if page * max_results < len(docs) else {}
+        return {"_items": chunk, "_links": links, "_meta": {"page": page, "max_results": max_results, "total": len(docs)}}
+
+    def start(self, port: int = 0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def match(doc, where):
+    for field, value in where.items():
+        if isinstance(value, dict) and "$in" in value:
+            if doc.get(field) not in value["$in"]:
+                return False
+        elif isinstance(doc.get(field), list):
+            if value not in doc[field]:
+                return False
+        elif doc.get(field) != value:
+            return False
+    return True
+
+def make_handler(ctis):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def route(self, method):
+            url = urllib.parse.urlparse(self.path)
+            path = [p for p in url.path.split("/") if p]
+            ctis.calls[(method, "/" + path[0])] += 1
+            if ctis.latency:
+                threading.Event().wait(ctis.latency)
+            return path, urllib.parse.parse_qs(url.query)
+
+        def body(self):
+            return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "null")
+
+        def do_GET(self):
+            path, query = self.route("GET")
+            if len(self.requestline) > MAX_REQUEST_LINE:
+                data = b"<html><body>Request Line is too large</body></html>"
+                self.send_response(400)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                return self.wfile.write(data)
+            if path[0] == "login":
+                return self.reply(200, {"data": {"access_token": "bench"}})
+            if len(path) > 1:
+                doc = ctis.collections.get(path[0], {}).get(path[1])
+                return self.reply(200 if doc else 404, doc or {"_status": "ERR"})
+            where = json.loads(query["where"][0]) if "where" in query else None
+            page = int(query.get("page", ["1"])[0])
+            max_results = int(query.get("max_results", ["25"])[0])
+            self.reply(200, ctis.find(path[0], where, page, max_results))
+
+        def do_POST(self):
+            path, _ = self.route("POST")
+            self.reply(*ctis.insert(path[0], self.body()))
+
+        def do_PATCH(self):
+            path, _ = self.route("PATCH")
+            doc = ctis.collections.get(path[0], {}).get(path[1])
+            if doc is None:
+                return self.reply(404, {"_status": "ERR"})
+            doc.update(self.body())
+            doc["_etag"] = uuid.uuid4().hex
+            self.reply(200, {"_id": path[1], "_etag": doc["_etag"], "_status": "OK"})
+
+    return Handler
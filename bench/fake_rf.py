@@ -0,0 +1,95 @@
+import copy
+import random
+import threading
+from datetime import datetime, timedelta
+
+from rfapi.datamodel import DotAccessDict
+
+ENTITY_TYPES = ["IpAddress", "InternetDomainName", "Hash", "Malware", "URL"]
+
+def entity_name(type, n):
+    if type == "IpAddress":
+        return f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}"
+    if type == "InternetDomainName":
+        return f"host{n}.example.com"
+    if type == "Hash":
+        return f"{n:064x}"
+    if type == "URL":
+        return f"http://host{n}.example.com/path"
+    return f"{type}-{n}"
+
+def make_alerts(count, owners=2, documents=3, references=5, entities=4, types=ENTITY_TYPES, pool=200, rules=5, seed=1):
+    """Synthetic alert details shaped like Recorded Future connect API alert lookups"""
+    rnd = random.Random(seed)
+    start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def docs(alert, section):
+        return [{
+            "title": f"Document {alert}-{section}-{d}",
+            "source": {"name": f"Source {rnd.randrange(20)}"},
+            "url": f"https://example.com/{alert}/{section}/{d}",
+            "authors": [{"name": f"Author {rnd.randrange(50)}"}],
+            "references": [{
+                "fragment": f"<p>Fragment {rnd.randrange(pool)} mentioning <b>indicators</b> in {section}</p>",
+                "entities": [{"name": entity_name(t, rnd.randrange(pool)), "type": t} for t in (rnd.choice(types) for _ in range(entities))]
+            } for _ in range(references)]
+        } for d in range(documents)]
+
+    alerts = []
+    for i in range(count):
+        rule = rnd.randrange(rules)
+        alerts.append({
+            "id": f"bench{i:06d}",
+            "title": f"[SRC{rule % 2}] Bench alert {i}\n",
+            "url": f"https://app.recordedfuture.com/live/sc/notification/?id=bench{i:06d}",
+            "triggered": (start + timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "rule": {"id": f"rule{rule}", "name": f"Bench rule {rule}", "url": f"https://example.com/rule/{rule}", "owner_name": "bench"},
+            "owner_organisation_details": {"organisations": [{"organisation_name": f"Org {rnd.randrange(owners * 2)}"} for _ in range(owners)]},
+            "entities": [{
+                "documents": docs(i, "docs"),
+                "entity": {"documents": docs(i, "ent")},
+                "risk": {"documents": docs(i, "risk")},
+                "trend": {}
+            }]
+        })
+    return alerts
+
+class FakeResponse():
+    def __init__(self, results):
+        self.results = results
+
+    @property
+    def entities(self):
+        for a in self.results:
+            yield DotAccessDict({"id": a["id"], "title": a["title"], "triggered": a["triggered"], "rule": {"id": a["rule"]["id"], "name": a["rule"]["name"]}})
+
+class FakeConnectApiClient():
+    """Stand-in for rfapi.ConnectApiClient serving a fixed list of synthetic alerts"""
+
+    alerts = []
+    by_id = {}
+    latency = 0
+    lookups = 0
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def search_alerts(self, **kwargs):
+        offset = kwargs.get("offset", 0)
+        limit = kwargs.get("limit", 100000)
+        return FakeResponse(self.alerts[offset:offset + limit])
+
+    def lookup_alert(self, alert_id):
+        if self.latency:
+            threading.Event().wait(self.latency)
+        with self.lock:
+            FakeConnectApiClient.lookups += 1
+        return {"data": copy.deepcopy(self.by_id[alert_id])}
+
+    @classmethod
+    def serve(cls, alerts, latency=0):
+        cls.alerts = alerts
+        cls.by_id = {a["id"]: a for a in alerts}
+        cls.latency = latency
+        cls.lookups = 0
@@ -0,0 +1,155 @@
+"""End-to-end throughput benchmark for the bridge.
+
+Runs main() against a local fake CTIS server and a stubbed rfapi.ConnectApiClient serving
+synthetic alerts, then reports alerts/sec, HTTP requests per alert by endpoint and per-alert
+latency. Exits non-zero when results regress past the stored baseline.
+
+    python bench/run_bench.py [--alerts 50] [--workers 4] [--update-baseline]
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import yaml
+
+BENCH = Path(__file__).resolve().parent
+SRC = BENCH.parent / "src"
+sys.path.insert(0, str(BENCH))
+
+from fake_ctis import FakeCTIS
+from fake_rf import FakeConnectApiClient, make_alerts, ENTITY_TYPES
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--alerts", type=int, default=50)
+    parser.add_argument("--owners", type=int, default=2, help="owner organisations per alert")
+    parser.add_argument("--documents", type=int, default=3, help="documents per alert section")
+    parser.add_argument("--references", type=int, default=5, help="references per document")
+    parser.add_argument("--entities", type=int, default=4, help="entities per reference")
+    parser.add_argument("--types", default=",".join(ENTITY_TYPES), help="comma separated RF entity types")
+    parser.add_argument("--pool", type=int, default=200, help="distinct entity names per type")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--ctis-latency", type=float, default=0.002, help="seconds added to every CTIS request")
+    parser.add_argument("--rf-latency", type=float, default=0.02, help="seconds added to every RF alert lookup")
+    parser.add_argument("--baseline", default=str(BENCH / "baseline.json"))
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative slowdown of alerts/sec and p99")
+    parser.add_argument("--request-tolerance", type=float, default=0.05, help="allowed relative growth of requests per alert")
+    return parser.parse_args()
+
+def write_config(path, ctis_url, args):
+    types = args.types.split(",")
+    config = {
+        "ctis": {"url": ctis_url, "username": "bench", "password": "bench", "pool_size": max(10, args.workers * 2), "batch_size": args.batch_size, "retries": 0},
+        "recorded_future": {"token": "bench"},
+        "sync": {"workers": args.workers},
+        # the last type is left unmapped on purpose to exercise the missing-mapping path
+        "mappings": {"entities": {t: {"type": t.lower(), "param": "value", "description": "description"} for t in types[:-1] or types}}
+    }
+    with open(path, "w") as f:
+        yaml.dump(config, f)
+
+def load_bridge():
+    import rfapi
+    rfapi.ConnectApiClient = FakeConnectApiClient
+    sys.path.insert(0, str(SRC))
+    spec = importlib.util.spec_from_file_location("bridge", SRC / "RF-CTIS-bridge.py")
+    bridge = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bridge)
+    return bridge
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run(args):
+    ctis = FakeCTIS(args.ctis_latency)
+    ctis_url = ctis.start()
+    alerts = make_alerts(args.alerts, args.owners, args.documents, args.references, args.entities, args.types.split(","), args.pool)
+    FakeConnectApiClient.serve(alerts, args.rf_latency)
+
+    tmp = tempfile.mkdtemp(prefix="rf-ctis-bench-")
+    write_config(f"{tmp}/config.yaml", ctis_url, args)
+    os.environ["RW_CONFIG_PATH"] = f"{tmp}/config.yaml"
+    os.environ["RW_FILES_PATH"] = tmp
+    logging.disable(logging.WARNING)
+
+    bridge = load_bridge()
+    latencies = []
+    lock = threading.Lock()
+    process_alert = bridge.process_alert
+
+    def timed_process_alert(*args):
+        start = time.perf_counter()
+        try:
+            return process_alert(*args)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - start)
+    bridge.process_alert = timed_process_alert
+
+    start = time.perf_counter()
+    bridge.main([])
+    elapsed = time.perf_counter() - start
+    ctis.stop()
+
+    by_endpoint = {}
+    for (method, endpoint), count in sorted(ctis.calls.items()):
+        by_endpoint[f"{method} {endpoint}"] = round(count / args.alerts, 3)
+    return {
+        "scenario": {k: v for k, v in vars(args).items() if k not in ("baseline", "update_baseline", "tolerance", "request_tolerance")},
+        "alerts_per_sec": round(args.alerts / elapsed, 2),
+        "requests_per_alert": round(sum(ctis.calls.values()) / args.alerts, 3),
+        "requests_per_alert_by_endpoint": by_endpoint,
+        "rf_lookups": FakeConnectApiClient.lookups,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "mean": round(statistics.mean(latencies) * 1000, 1) if latencies else 0
+        }
+    }
+
+def compare(results, baseline, args):
+    if baseline["scenario"] != results["scenario"]:
+        print("Scenario differs from the stored baseline, skipping regression check")
+        return []
+    failures = []
+    if results["alerts_per_sec"] < baseline["alerts_per_sec"] * (1 - args.tolerance):
+        failures.append(f"alerts/sec {results['alerts_per_sec']} < baseline {baseline['alerts_per_sec']}")
+    if results["latency_ms"]["p99"] > baseline["latency_ms"]["p99"] * (1 + args.tolerance):
+        failures.append(f"p99 latency {results['latency_ms']['p99']}ms > baseline {baseline['latency_ms']['p99']}ms")
+    if results["requests_per_alert"] > baseline["requests_per_alert"] * (1 + args.request_tolerance):
+        failures.append(f"requests/alert {results['requests_per_alert']} > baseline {baseline['requests_per_alert']}")
+    return failures
+
+def main():
+    args = parse_args()
+    results = run(args)
+    print(json.dumps(results, indent=2))
+
+    baseline_path = Path(args.baseline)
+    if args.update_baseline:
+        baseline_path.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline written to {baseline_path}")
+        return 0
+    if not baseline_path.is_file():
+        print("No baseline stored, run with --update-baseline to create one")
+        return 0
+    failures = compare(results, json.loads(baseline_path.read_text()), args)
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,28 @@
 import logging
+import signal
 import sys
+import threading
+import time
 import traceback
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+started = time.perf_counter()
 
-from config import Config
+from config import Config, FilesPath, Tenant
 from notifications import NotificationManager
-from notifications.ctis import CTIS
+from notifications.ctis import CTIS, ReqStat
+from state import StateStore
+from alert_cache import AlertCache
+from summary import AlertSummary
+from metrics import metrics
+from ratelimit import limits
 
 from rfapi import ConnectApiClient
+from rfapi.datamodel import DotAccessDict
+from rfapi.error import HttpError
 import re
-import json, yaml
+import json
 import random
 import string
 from datetime import datetime
@@ -24,145 +38,455 @@ logging.basicConfig(
     ]
 )
 
-def add_dossiers_rels(alert, dossiers):
+def add_dossiers_rels(alert, dossiers, batch):
     for dossier in dossiers:
-        ctis.add_relationship("related-to", alert, "alerts", dossier, "x-dossiers")
+        ctis.add_relationship("related-to", alert, "alerts", dossier, "x-dossiers", batch)
 
-def parse_docs_and_create(documents, owner):
+def add_victims_rels(alert, owners, batch):
+    for owner in dict.fromkeys(owners):
+        ctis.add_relationship_al_vic("related-to", alert, "alerts", owner, "identities", batch)
+
+def resolve_owners(owners, known, journal):
+    # owners resolved by an interrupted run are reused, the others are resolved together
+    ids = ctis.add_identities([name for i, name in enumerate(owners) if f"owner:{i}" not in known])
+    owners_ctis = []
+    for i, name in enumerate(owners):
+        if f"owner:{i}" not in known:
+            journal(f"owner:{i}", "identities", ids[name])
+        owners_ctis.append(known.get(f"owner:{i}", ids.get(name)))
+    return owners_ctis
+
+def notify_entity_error(e, fragment, error=None):
+    logging.error(f"Got a NON fatal error while creating entity {e['name']} of type {e['type']} with fragment {fragment}, notifying")
+    tb = error + "\n" if error else traceback.format_exc()
+    # send slack error notifications
+    NotificationManager.send_error_notification(
+            "Entity creation error", f"Entity {e['name']} of type {e['type']} with fragment {fragment}\n" + tb, fatal=False)
+    # log exception
+    logging.error(tb.strip())  # there is a trailing newline
+
+def iter_references(doc):
+    for ref in doc["references"]:
+        yield ref["fragment"], ref["entities"]
+
+def link_entities(ctis_dossier, pending, ctx, linked=False):
+    # entity ids are only known once their batch is flushed
+    ctx["batch"].flush()
+    last = None
+    for e, fragment, ctis_ent in pending:
+        try:
+            ctis_type = ctis.mappings.get(e["type"]).type
+            ctx["objects"][(ctis_type, ctis_ent.result())] = None
+            if not linked:
+                last = ctis.add_relationship("related-to", ctis_dossier, "x-dossiers", ctis_ent.result(), ctis_type, ctx["batch"])
+                # a rejected link is reported for its entity instead of failing the whole alert
+                last.on_error(lambda error, e=e, fragment=fragment: notify_entity_error(e, fragment, error))
+        except:
+            notify_entity_error(e, fragment)
+    pending.clear()
+    return last
+
+def pending_fragments(alert_element):
+    # fragments that add_entity will convert: some mapped entity of theirs isn't known to CTIS yet
+    for entity in alert_element["entities"]:
+        for documents in (entity, entity["entity"], entity["risk"], entity["trend"]):
+            if not documents or "documents" not in documents.keys():
+                continue
+            for doc in documents["documents"]:
+                for fragment, entities in iter_references(doc):
+                    for e in entities:
+                        mapping = ctis.mappings.get(e["type"])
+                        if mapping and ctis.entity_id(mapping.endpoint, e["name"]) is None:
+                            yield fragment
+                            break
+
+def parse_docs_and_create(documents, section, ctx, step):
     if not documents or "documents" not in documents.keys():
-        return None, None
-    documents = documents["documents"]
-    docs = []
-    ctis_docs = []
-    for doc in documents:
-        tmp = {}
+        return
+    summary = ctx["summary"]
+    for n, doc in enumerate(documents["documents"]):
         rand = ''.join(random.choice(string.ascii_lowercase) for i in range(16))
-        if doc["title"]:
-            tmp["title"] = doc["title"]
-        else:
-            tmp["title"] = rand
-        logging.debug("Doc title: " + tmp["title"])
-        if doc["source"]:
-            tmp["source"] = doc["source"]["name"]
-        else:
-            tmp["source"] = rand
-        logging.debug("Doc source: " + tmp["source"])
-        tmp["url"] = doc["url"]
+        title = doc["title"] if doc["title"] else rand
+        logging.debug("Doc title: " + title)
+        source = doc["source"]["name"] if doc["source"] else rand
+        logging.debug("Doc source: " + source)
         logging.debug("Doc url: " + str(doc["url"]))
-        tmp["authors"] = []
-        for author in doc["authors"]:
-            tmp["authors"].append(author["name"])
-        logging.debug("Doc authors: " + str(tmp["authors"]))
-        ctis_dossier = ctis.add_dossier(tmp["title"], tmp["source"], f"Url: {tmp['url']}\nAuthors: {tmp['authors']}", owner)
-        ctis_docs.append(ctis_dossier)
-        tmp["ref"] = []
-        for ref in doc["references"]:
-            tmp1 = {"fragment": ref["fragment"], "refs": []}
-            for e in ref["entities"]:
-                tmp1["refs"].append(e["name"])
-                logging.debug(f"Entity: name: {e['name']}, type: {e['type']}, frag: {ref['fragment']}")
+        authors = [author["name"] for author in doc["authors"]]
+        logging.debug("Doc authors: " + str(authors))
+        # dossiers have no natural key in CTIS, a replay reuses the one created by the same step
+        doc_step = f"{step}:{n}"
+        ctis_dossier = ctx["known"].get(doc_step)
+        if ctis_dossier is None:
+            ctis_dossier = ctis.add_dossier(title, source, f"Url: {doc['url']}\nAuthors: {authors}", ctx["owners"], ctx["xsources"])
+            ctx["journal"](doc_step, "x-dossiers", ctis_dossier)
+        ctx["dossiers"].append(ctis_dossier)
+        ctx["objects"][("x-dossiers", ctis_dossier)] = doc_step
+        summary_doc = summary.add_doc(section, title, source, doc["url"], authors)
+        links_step = f"{doc_step}:links"
+        linked = links_step in ctx["known"]
+        last = None
+        pending = []
+        for fragment, entities in iter_references(doc):
+            summary.add_reference(section)
+            for e in entities:
+                summary.add_entity(section, summary_doc, e["name"], e["type"])
+                logging.debug(f"Entity: name: {e['name']}, type: {e['type']}, frag: {fragment}")
                 try:
-                    ctis_ent = ctis.add_entity(e["name"], e["type"], ref["fragment"])
+                    ctis_ent = ctis.add_entity(e["name"], e["type"], fragment, ctx["xsources"], ctx["batch"])
                     if ctis_ent:
-                        ctis.add_relationship("related-to", ctis_dossier, "x-dossiers", ctis_ent, Config["mappings"]["entities"][e["type"]]["type"])
+                        pending.append((e, fragment, ctis_ent))
                 except:
-                    logging.error(f"Got a NON fatal error while creating entity {e['name']} of type {e['type']} with fragment {ref['fragment']}, notifying")
-                    tb = traceback.format_exc()
-                    # send slack error notifications
-                    NotificationManager.send_error_notification(
-                            "Entity creation error", f"Entity {e['name']} of type {e['type']} with fragment {ref['fragment']}\n" + tb, fatal=False)
-                    # log exception
-                    logging.error(tb.strip())  # there is a trailing newline
-            tmp["ref"].append(tmp1)
-        logging.debug("Entity refs: " + str(tmp["ref"]))
-        docs.append(tmp)
-    return docs, ctis_docs
-
-rf = ConnectApiClient(auth=Config["recorded_future"]["token"])
-ctis = CTIS(Config["ctis"]["url"], Config["ctis"]["username"], Config["ctis"]["password"])
-
-def main(argv):
-    logging.info("Started")
-
-    NotificationManager.send_info_notification("Starting sync")
-
-    today = datetime.today().strftime("%Y-%m-%d")
-    yesterday = (datetime.today() - timedelta(days=1)).strftime("%Y-%m-%d")
-    alerts_file = Path(f"/files/{today}.txt")
-    alerts_file_old = Path(f"/files/{yesterday}.txt")
-    if not alerts_file.is_file():
-        alerts_file.touch()
-        if alerts_file_old.is_file(): alerts_file_old.unlink()
-    old_alerts = set(line.strip() for line in open(f"/files/{today}.txt"))
-    alerts = rf.search_alerts(triggered=today, freetext="", limit=100000).entities
+                    notify_entity_error(e, fragment)
+                if len(pending) >= ctx["batch"].size:
+                    last = link_entities(ctis_dossier, pending, ctx, linked) or last
+        last = link_entities(ctis_dossier, pending, ctx, linked) or last
+        if not linked:
+            journal_links(ctx, links_step, ctis_dossier, last)
 
-    for alert in alerts:
-        if alert["id"] in old_alerts: continue
+def journal_links(ctx, step, ctis_dossier, last):
+    # relationships are flushed in order, once the last one of a dossier is written so are the others
+    if last is None:
+        ctx["journal"](step, "relationships", ctis_dossier)
+    else:
+        last.on_done(lambda ok, res, doc: ok != ReqStat.ERR and ctx["journal"](step, "relationships", ctis_dossier))
+
+# spawned html2text workers import this script again as __mp_main__, they only need
+# notifications.convert and must not open the state store or scan the alert cache
+if __name__ != "__mp_main__":
+    rf = ConnectApiClient(auth=Config["recorded_future"]["token"])
+    state = StateStore(f"{FilesPath}/state.db", Config.get("state", {}).get("retention_days", 7), Config.get("state", {}).get("entity_retention_days", 30))
+    ctis = CTIS(Config["ctis"]["url"], Config["ctis"]["username"], Config["ctis"]["password"], state)
+    alert_cache_mb = Config.get("alert_cache", {}).get("max_mb", 512)
+    alert_cache = AlertCache(f"{FilesPath}/alert_cache", alert_cache_mb * 1024 * 1024) if alert_cache_mb else None
+    if Tenant:
+        metrics.labels = (("tenant", Tenant),)
+    metrics.set("startup_seconds", time.perf_counter() - started)
+
+def lookup_alert(alert_id):
+    if alert_cache:
+        cached = alert_cache.get(alert_id)
+        if cached is not None:
+            metrics.inc("rf_alert_cache_total", result="hit")
+            return DotAccessDict(cached)
+        metrics.inc("rf_alert_cache_total", result="miss")
+    alert_element = fetch_alert(alert_id)
+    if alert_cache:
+        alert_cache.put(alert_id, alert_element)
+    return alert_element
+
+def fetch_alert(alert_id):
+    retries = Config["recorded_future"].get("retries", 5)
+    for attempt in range(retries + 1):
         try:
-            Config["xsources"] = re.findall("\[(.*?)\]", alert["title"])
-        except:
-            Config["xsources"] = []
-        my_alert = {}
-        alert_element = rf.lookup_alert(alert.id)["data"]
+            with metrics.timer("rf_lookup_alert_seconds"), limits.slot("rf/alert") as slot:
+                try:
+                    return rf.lookup_alert(alert_id)["data"]
+                except HttpError as e:
+                    slot.overloaded = e.status_code in (429, 503)
+                    raise
+        except HttpError as e:
+            if e.status_code not in (429, 502, 503, 504) or attempt == retries:
+                raise
+            delay = float(e.response.headers.get("Retry-After", 2 ** attempt))
+            logging.warning(f"RF lookup of {alert_id} got {e.status_code}, retrying in {delay}s")
+            metrics.inc("rf_lookup_retries_total", status=e.status_code)
+            time.sleep(delay)
 
-        logging.debug("Alert title: " + alert_element["title"])
-        logging.debug("Alert url: " + alert_element["url"])
-        my_alert["title"] = alert_element["title"].replace("\n", "")
-        my_alert["url"] = alert_element["url"]
+@metrics.timed("alert_seconds")
+def process_alert(alert, alert_element, known=None):
+    # known maps the steps of an earlier run of this alert to the CTIS ids they created:
+    # the journal of a run that died halfway, or the objects of a replayed alert
+    try:
+        xsources = re.findall("\[(.*?)\]", alert["title"])
+    except:
+        xsources = []
 
-        if ctis.check_alert_exists(alert.id, my_alert["title"]):
-            continue
+    logging.debug("Alert title: " + alert_element["title"])
+    logging.debug("Alert url: " + alert_element["url"])
+    title = alert_element["title"].replace("\n", "")
+    opts = Config.get("sync", {})
+    summary = AlertSummary(opts.get("summary_max_items", 25), opts.get("summary_max_bytes", 65536))
+    summary.data["title"] = title
+    summary.data["url"] = alert_element["url"]
+
+    result = {"title": title, "triggered": alert_element.get("triggered"), "ctis_id": None, "objects": {}, "new": False}
+    if known is None and ctis.check_alert_exists(alert.id, title):
+        return result
+    if known:
+        logging.info(f"Resuming alert {alert.id} from {len(known)} completed steps")
+    # a replayed or resumed alert may already be in CTIS even when no step of it is known,
+    # e.g. it existed on the first run or its objects were pruned
+    existing_ok = known is not None
+    known = known or {}
+    xsources = ctis.resolve_xsources(xsources)
+    objects = result["objects"]
+
+    def journal(step, kind, ctis_id):
+        state.journal(alert.id, step, kind, ctis_id)
+
+    owners = [owner["organisation_name"] for owner in alert_element["owner_organisation_details"]["organisations"]]
+    owners_ctis = resolve_owners(owners, known, journal)
+    for i, owner_ctis in enumerate(owners_ctis):
+        objects.setdefault(("identities", owner_ctis), f"owner:{i}")
+    logging.debug("Alert owners: " + str(owners))
+    summary.data["owners"] = owners
 
-        owners = []
-        owners_ctis = []
-        for owner in alert_element["owner_organisation_details"]["organisations"]:
-            owners.append(owner["organisation_name"])
-            owner_ctis = ctis.add_identity(owner["organisation_name"])
-            owners_ctis.append(owner_ctis)
-        logging.debug("Alert owners: " + str(owners))
-        my_alert["owners"] = owners
-
-        logging.debug("Alert rule name: " + alert_element["rule"]["name"])
-        logging.debug("Alert rule url: " + alert_element["rule"]["url"])
-        logging.debug("Alert rule owner: " + alert_element["rule"]["owner_name"])
-        my_alert["rule"] = {"name": alert_element["rule"]["name"], "url": alert_element["rule"]["url"], "owner": alert_element["rule"]["owner_name"]}
-        eei_alert_rule = ctis.add_eei(alert_element["rule"]["id"], my_alert["rule"]["name"], my_alert["rule"]["url"], my_alert["rule"]["owner"])
-
-        ctis_docs = {}
-        for entity in alert_element["entities"]:
+    logging.debug("Alert rule name: " + alert_element["rule"]["name"])
+    logging.debug("Alert rule url: " + alert_element["rule"]["url"])
+    logging.debug("Alert rule owner: " + alert_element["rule"]["owner_name"])
+    rule = {"name": alert_element["rule"]["name"], "url": alert_element["rule"]["url"], "owner": alert_element["rule"]["owner_name"]}
+    summary.data["rule"] = rule
+    eei_alert_rule = known.get("eei")
+    if eei_alert_rule is None:
+        eei_alert_rule = ctis.add_eei(alert_element["rule"]["id"], rule["name"], rule["url"], rule["owner"], xsources)
+        journal("eei", "eeis", eei_alert_rule)
+    objects[("eeis", eei_alert_rule)] = "eei"
+
+    ctis.converter.prewarm(pending_fragments(alert_element))
+    with ctis.batch() as batch:
+        ctx = {"owners": owners, "xsources": xsources, "batch": batch, "objects": objects, "summary": summary, "dossiers": [], "known": known, "journal": journal}
+        for i, entity in enumerate(alert_element["entities"]):
             logging.debug("General docs")
-            my_alert["docs"], ctis_docs["docs"] = parse_docs_and_create(entity, owners)
+            parse_docs_and_create(entity, "docs", ctx, f"docs:{i}")
             logging.debug("Entity docs")
-            my_alert["ent"], ctis_docs["ent"] = parse_docs_and_create(entity["entity"], owners)
+            parse_docs_and_create(entity["entity"], "ent", ctx, f"ent:{i}")
             logging.debug("Risk docs")
-            my_alert["risk"], ctis_docs["risk"] = parse_docs_and_create(entity["risk"], owners)
+            parse_docs_and_create(entity["risk"], "risk", ctx, f"risk:{i}")
             logging.debug("Trend docs")
-            my_alert["trend"], ctis_docs["trend"] = parse_docs_and_create(entity["trend"], owners)
-
-        alert_ctis = ctis.add_alert(alert.id, my_alert["title"], f"RF alert url: {my_alert['url']}\nALERT SUMMARY:\n{yaml.dump(my_alert)}")
-        ctis.add_relationship("related-to", eei_alert_rule, "eeis", alert_ctis, "alerts")
-        for owner in owners_ctis:
-            ctis.add_relationship_al_vic("related-to", alert_ctis, "alerts", owner_ctis, "identities")
-        for k, docs in ctis_docs.items():
-            if docs: add_dossiers_rels(alert_ctis, docs)
-        NotificationManager.send_info_notification(f"Added new alert: {my_alert['title']} - {str(alert.id)}")
-        with open(f"/files/{today}.txt", "a") as out:
-            out.write(f"{alert['id']}\n")
-
-    NotificationManager.send_info_notification("Finished, exiting")
+            parse_docs_and_create(entity["trend"], "trend", ctx, f"trend:{i}")
+
+        with metrics.timer("summary_dump_seconds"):
+            message = f"RF alert url: {alert_element['url']}\nALERT SUMMARY:\n{summary.dump()}"
+        alert_ctis = known.get("alert")
+        if alert_ctis is None:
+            alert_ctis = ctis.add_alert(alert.id, title, message, xsources, existing_ok=existing_ok)
+            journal("alert", "alerts", alert_ctis)
+        ctis.add_relationship("related-to", eei_alert_rule, "eeis", alert_ctis, "alerts", batch)
+        add_victims_rels(alert_ctis, owners_ctis, batch)
+        add_dossiers_rels(alert_ctis, ctx["dossiers"], batch)
+    result["ctis_id"] = alert_ctis
+    result["new"] = True
+    return result
+
+def ordered_pool(func, items, workers, window_size):
+    # func runs concurrently over items but results are yielded back in input
+    # order, with at most window_size items in flight
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for item in items:
+                window.append((item, pool.submit(func, item)))
+                if len(window) >= window_size:
+                    item_done, fut = window.popleft()
+                    yield item_done, fut.result()
+            while window:
+                item_done, fut = window.popleft()
+                yield item_done, fut.result()
+        except:
+            for _, fut in window:
+                fut.cancel()
+            raise
+
+def process_alerts(alerts, workers, prefetch):
+    # RF lookups for the next alerts run ahead of the CTIS writers, and the
+    # state store never records an alert before the ones preceding it
+    fetched = ordered_pool(lambda alert: lookup_alert(alert.id), alerts, prefetch, prefetch)
+    # an alert with journal entries was interrupted by a crash and resumes where it stopped
+    resume = lambda pair: process_alert(*pair, state.journal_steps(pair[0].id) or None)
+    for (alert, _), result in ordered_pool(resume, fetched, workers, workers * 2):
+        yield alert, result
+
+def search_new_alerts():
+    opts = Config.get("sync", {})
+    if not opts.get("incremental", False):
+        today = datetime.today().strftime("%Y-%m-%d")
+        with limits.slot("rf/search"):
+            res = rf.search_alerts(triggered=today, freetext="", limit=100000)
+        yield from res.entities
+        return
+    cursor = state.get_meta("cursor")
+    if cursor:
+        since = datetime.fromisoformat(cursor.rstrip("Z")) - timedelta(minutes=opts.get("overlap_minutes", 10))
+    else:
+        since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    triggered = f"[{since.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}Z,]"
+    logging.info(f"Searching alerts triggered in {triggered}")
+    page_size = opts.get("page_size", 1000)
+    offset = 0
+    while True:
+        count = 0
+        with limits.slot("rf/search"):
+            res = rf.search_alerts(triggered=triggered, freetext="", order_by="triggered", direction="asc", limit=page_size, offset=offset)
+        for alert in res.entities:
+            count += 1
+            yield alert
+        if count < page_size:
+            return
+        offset += count
+
+def unprocessed(alerts):
+    # search pages can overlap, and nothing already in the state store is ever looked up
+    seen = set()
+    for alert in alerts:
+        if alert["id"] in seen or state.is_processed(alert["id"]):
+            continue
+        seen.add(alert["id"])
+        yield alert
+
+def preresolve(alerts):
+    # one $in query per kind instead of one existence probe per alert, rule and x-source,
+    # process_alert then finds the answers in the lookup cache
+    if not alerts:
+        return
+    with metrics.timer("preresolve_seconds"):
+        ctis.check_alerts_exist([(alert["id"], alert["title"].replace("\n", "")) for alert in alerts])
+        ctis.check_eeis_exist([(alert["rule"]["id"], alert["rule"]["name"]) for alert in alerts if alert.get("rule")])
+        ctis.check_xsources_exist([name for alert in alerts for name in re.findall("\[(.*?)\]", alert["title"])])
+
+def preresolved(alerts, chunk_size):
+    # resolved a page at a time, so processing starts before the whole search is read
+    alerts = iter(alerts)
+    while True:
+        chunk = list(islice(alerts, chunk_size))
+        if not chunk:
+            return
+        preresolve(chunk)
+        yield from chunk
+
+def main(argv, stop=None):
+    logging.info(f"Started, imports and setup took {time.perf_counter() - started:.2f}s" if stop is None else "Started")
+
+    # in daemon mode only start/stop of the daemon itself is notified
+    if stop is None:
+        NotificationManager.send_info_notification("Starting sync")
+
+    since = metrics.snapshot()
+    start = time.perf_counter()
+    added = 0
+    processed = 0
+
+    for ledger in Path(FilesPath).glob("????-??-??.txt"):
+        state.import_ledger(ledger)
+    state.prune()
+    if stop is not None:
+        # the daemon outlives the alias index, identities added to CTIS since the last cycle must show up
+        ctis.identities.reset()
+    alerts = preresolved(unprocessed(search_new_alerts()), Config.get("sync", {}).get("page_size", 1000))
+
+    workers = Config.get("sync", {}).get("workers", 1)
+    prefetch = Config.get("sync", {}).get("prefetch", workers)
+    incremental = Config.get("sync", {}).get("incremental", False)
+    cursor = state.get_meta("cursor", "")
+    for alert, result in process_alerts(alerts, workers, prefetch):
+        state.mark_processed(alert["id"], result["ctis_id"], result["title"], result["triggered"], result["objects"])
+        # alerts come back in trigger order, so everything before the cursor is committed
+        if incremental and alert.get("triggered") and alert["triggered"] > cursor:
+            cursor = alert["triggered"]
+            state.set_meta("cursor", cursor)
+        metrics.inc("alerts_processed_total", new=result["new"])
+        processed += 1
+        if result["new"]:
+            added += 1
+            NotificationManager.send_info_notification(f"Added new alert: {result['title']} - {str(alert.id)}")
+        if stop is not None and stop.is_set():
+            logging.info("Shutdown requested, leaving the remaining alerts for the next start")
+            break
+
+    if not ctis.headers:
+        logging.info("Nothing to write, CTIS login skipped")
+    limits.log_state()
+    ctis.mappings.write_missing(f"{FilesPath}/missing_entities.txt")
+    metrics.observe("sync_seconds", time.perf_counter() - start)
+    metrics.set("sync_last_success_timestamp_seconds", time.time())
+    if "textfile" in Config.get("metrics", {}):
+        metrics.write_textfile(Config["metrics"]["textfile"])
+    if stop is None or added:
+        NotificationManager.send_info_notification(f"Sync added {added} alerts in {time.perf_counter() - start:.1f}s\n" + metrics.summary(since))
+    if stop is None:
+        # the daemon keeps its html2text workers across cycles
+        ctis.converter.close()
+        NotificationManager.send_info_notification("Finished, exiting")
     logging.info("Finished, exiting")
+    return {"processed": processed, "added": added, "seconds": time.perf_counter() - start}
 
-if __name__ == "__main__":
-    try:
-        main(sys.argv)
-    except:
-        logging.error(f"Got a fatal error, notifying + aborting")
+def replay(argv):
+    """Re-run alerts from the alert cache without calling RF, e.g. after a mappings change"""
+    if not alert_cache:
+        logging.error("The alert cache is disabled, nothing to replay")
+        return
+    ids = argv[argv.index("replay") + 1:] or alert_cache.ids()
+    logging.info(f"Replaying {len(ids)} cached alerts")
+    start = time.perf_counter()
 
-        tb = traceback.format_exc()
+    def replay_alert(alert_id):
+        alert_element = alert_cache.get(alert_id)
+        if alert_element is None:
+            logging.warning(f"Alert {alert_id} is not in the alert cache, skipping")
+            return None
+        alert = DotAccessDict({"id": alert_id, "title": alert_element["title"], "triggered": alert_element.get("triggered")})
+        known = {step: ctis_id for kind, ctis_id, step in state.objects(alert_id) if step}
+        return process_alert(alert, DotAccessDict(alert_element), known)
 
-        # send slack error notifications
-        NotificationManager.send_error_notification(
-            f"Fatal error", tb, fatal=True)
+    workers = Config.get("sync", {}).get("workers", 1)
+    replayed = 0
+    for alert_id, result in ordered_pool(replay_alert, ids, workers, workers * 2):
+        if result is None:
+            continue
+        state.mark_processed(alert_id, result["ctis_id"], result["title"], result["triggered"], result["objects"])
+        replayed += 1
+    ctis.converter.close()
+    ctis.mappings.write_missing(f"{FilesPath}/missing_entities.txt")
+    NotificationManager.send_info_notification(f"Replayed {replayed} cached alerts in {time.perf_counter() - start:.1f}s")
+    logging.info("Finished, exiting")
+
+def notify_fatal():
+    logging.error(f"Got a fatal error, notifying + aborting")
+
+    tb = traceback.format_exc()
+
+    # send slack error notifications
+    NotificationManager.send_error_notification(
+        f"Fatal error", tb, fatal=True)
+
+    # log exception
+    logging.error(tb.strip())  # there is a trailing newline
+
+def daemon(argv):
+    opts = Config.get("daemon", {})
+    interval = opts.get("interval", 120)
+    jitter = opts.get("jitter", 15)
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        logging.info(f"Got signal {signum}, stopping after the current cycle")
+        stop.set()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
 
-        # log exception
-        logging.error(tb.strip())  # there is a trailing newline
+    NotificationManager.send_info_notification(f"Daemon started, syncing every {interval}s")
+    # cycles run back to back on this thread, the next one is only scheduled
+    # once the previous one returned, so they can never overlap
+    while not stop.is_set():
+        try:
+            main(argv, stop)
+        except:
+            # a failed cycle is retried on the next tick instead of killing the daemon
+            notify_fatal()
+        stop.wait(interval + random.uniform(0, jitter))
+    ctis.converter.close()
+    NotificationManager.send_info_notification("Daemon stopped")
+    logging.info("Daemon stopped")
+
+if __name__ == "__main__":
+    if "port" in Config.get("metrics", {}):
+        metrics.serve(Config["metrics"]["port"])
+    if "--daemon" in sys.argv:
+        daemon(sys.argv)
+        sys.exit(0)
+    try:
+        if "replay" in sys.argv:
+            replay(sys.argv)
+        else:
+            main(sys.argv)
+    except:
+        notify_fatal()
@@ -0,0 +1,85 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import urllib.parse
+from pathlib import Path
+
+class AlertCache():
+    """Content-addressed, gzip-compressed store of raw RF alert lookups.
+
+    objects/<hash[:2]>/<hash>.json.gz holds each distinct payload, refs/<alert id> the hash of
+    the latest payload for that alert. Least recently used objects are evicted past max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        (self.path / "objects").mkdir(parents=True, exist_ok=True)
+        (self.path / "refs").mkdir(parents=True, exist_ok=True)
+        self.size = sum(f.stat().st_size for f in (self.path / "objects").glob("*/*.json.gz"))
+
+    def ref(self, alert_id):
+        return self.path / "refs" / urllib.parse.quote(alert_id, safe="")
+
+    def object(self, digest):
+        return self.path / "objects" / digest[:2] / f"{digest}.json.gz"
+
+    def get(self, alert_id):
+        try:
+            obj = self.object(self.ref(alert_id).read_text().strip())
+            with gzip.open(obj, "rt") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        try:
+            # mtime is the LRU clock
+            os.utime(obj)
+        except FileNotFoundError:
+            # evicted by a put() on another thread since it was read, the data is still good
+            pass
+        return data
+
+    def put(self, alert_id, data):
+        raw = json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+        digest = hashlib.sha256(raw).hexdigest()
+        obj = self.object(digest)
+        with self.lock:
+            if not obj.is_file():
+                obj.parent.mkdir(exist_ok=True)
+                tmp = obj.with_suffix(".tmp")
+                with gzip.open(tmp, "wb") as f:
+                    f.write(raw)
+                os.replace(tmp, obj)
+                self.size += obj.stat().st_size
+            ref = self.ref(alert_id)
+            tmp = ref.parent / f"{ref.name}.tmp"
+            tmp.write_text(digest)
+            os.replace(tmp, ref)
+            if self.size > self.max_bytes:
+                self.evict()
+        return digest
+
+    def evict(self):
+        objects = sorted((f.stat().st_mtime, f.stat().st_size, f) for f in (self.path / "objects").glob("*/*.json.gz"))
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, f in objects:
+            if self.size <= target:
+                break
+            f.unlink()
+            self.size -= size
+            removed += 1
+        # refs pointing at evicted objects are dropped lazily here so ids() stays accurate
+        for ref in (self.path / "refs").iterdir():
+            if ref.name.endswith(".tmp"):
+                continue
+            if not self.object(ref.read_text().strip()).is_file():
+                ref.unlink()
+        logging.info(f"Evicted {removed} cached alert payloads, cache is now {self.size // 1024} KiB")
+
+    def ids(self):
+        return sorted(urllib.parse.unquote(ref.name) for ref in (self.path / "refs").iterdir() if not ref.name.endswith(".tmp"))
@@ -3,4 +3,27 @@ from typing import Dict
 import yaml
 
 with open(os.getenv("RW_CONFIG_PATH", "config.yaml"), "r") as f:
-    Config: Dict = yaml.load(f, Loader=yaml.CLoader)
\ No newline at end of file
+    Config: Dict = yaml.load(f, Loader=yaml.CLoader)
+
+FilesPath: str = os.getenv("RW_FILES_PATH", "/files")
+
+def merge(base: Dict, override: Dict) -> Dict:
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = merge(merged[key], value)
+        merged[key] = value
+    return merged
+
+# set by tenants.py in each tenant process: that tenant's entry is laid over the shared config
+Tenant: str = os.getenv("RW_TENANT")
+if Tenant:
+    tenant = next(t for t in Config["tenants"] if t["name"] == Tenant)
+    Config = merge(Config, tenant)
+    FilesPath = f"{FilesPath}/{Tenant}"
+    os.makedirs(FilesPath, exist_ok=True)
+    # node_exporter reads one textfile directory, each tenant writes its own file there
+    textfile = Config.get("metrics", {}).get("textfile")
+    if textfile and "textfile" not in tenant.get("metrics", {}):
+        root, ext = os.path.splitext(textfile)
+        Config["metrics"] = {**Config["metrics"], "textfile": f"{root}.{Tenant}{ext}"}
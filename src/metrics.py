@@ -0,0 +1,159 @@
+from contextlib import contextmanager
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import os
+import threading
+import time
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+def label_str(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class Histogram():
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+class Metrics():
+    """Call counters and latency histograms, exported in Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # added to every exported series, e.g. the tenant of a multi-tenant run
+        self.labels = ()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, call=func.__name__, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            return {key: (h.count, h.sum) for key, h in self.histograms.items()}, dict(self.counters)
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for name in sorted({k[0] for k in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{label_str(self.labels + labels)} {value}")
+            for name in sorted({k[0] for k in self.gauges}):
+                lines.append(f"# TYPE {name} gauge")
+                for (n, labels), value in sorted(self.gauges.items()):
+                    if n == name:
+                        lines.append(f"{name}{label_str(self.labels + labels)} {value}")
+            for name in sorted({k[0] for k in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), h in sorted(self.histograms.items(), key=lambda i: i[0]):
+                    if n != name:
+                        continue
+                    labels = self.labels + labels
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, h.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else bound
+                        lines.append(f"{name}_bucket{label_str(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{label_str(labels)} {h.sum}")
+                    lines.append(f"{name}_count{label_str(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        # write then rename so a scraping node_exporter never reads a partial file
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def serve(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                data = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def summary(self, since=None, top=10):
+        hist_before, counters_before = since or ({}, {})
+        hists, counters = self.snapshot()
+        stages = []
+        for key, (count, total) in hists.items():
+            count -= hist_before.get(key, (0, 0))[0]
+            total -= hist_before.get(key, (0, 0))[1]
+            if count:
+                stages.append((total, count, key))
+        stages.sort(reverse=True)
+        lines = ["*Time per stage* (total / calls / mean)"]
+        for total, count, (name, labels) in stages[:top]:
+            lines.append(f"`{name}{label_str(labels)}` {total:.2f}s / {count} / {total / count * 1000:.1f}ms")
+        statuses = {}
+        for (name, labels), value in counters.items():
+            if name != "ctis_http_responses_total":
+                continue
+            value -= counters_before.get((name, labels), 0)
+            if value:
+                labels = dict(labels)
+                statuses.setdefault(labels["endpoint"], []).append(f"{labels['status']}: {value}")
+        if statuses:
+            lines.append("*CTIS responses per endpoint*")
+            for endpoint, counts in sorted(statuses.items()):
+                lines.append(f"`{endpoint}` " + ", ".join(sorted(counts)))
+        return "\n".join(lines)
+
+metrics = Metrics()
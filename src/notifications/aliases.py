@@ -0,0 +1,60 @@
+import json
+import logging
+import threading
+import urllib.parse
+
+class AliasResolver():
+    """Resolves identity aliases to CTIS _ids.
+
+    In "index" mode the collection is paged through once and kept as an alias -> _id dict,
+    in "where" mode every lookup is a server-side filtered query.
+    """
+
+    def __init__(self, ctis, entity_url: str, mode: str = "index", page_size: int = 1000):
+        self.ctis = ctis
+        self.entity_url = entity_url
+        self.mode = mode
+        self.page_size = page_size
+        self.index = None
+        self.lock = threading.Lock()
+
+    def pages(self, where=None):
+        page = 1
+        while True:
+            query = f"{self.entity_url}?page={page}&max_results={self.page_size}&projection=%7B%22aliases%22%3A%201%7D"
+            if where:
+                query += "&where=" + urllib.parse.quote(json.dumps(where))
+            cur = self.ctis.do_get(query)
+            yield cur.get("_items", [])
+            if "next" not in cur.get("_links", {}):
+                return
+            page += 1
+
+    def build(self):
+        index = {}
+        for items in self.pages():
+            for e in items:
+                for alias in e.get("aliases", []):
+                    index.setdefault(alias, e["_id"])
+        logging.info(f"Indexed {len(index)} aliases from {self.entity_url}")
+        return index
+
+    def resolve(self, name):
+        if self.mode == "where":
+            for items in self.pages({"aliases": name}):
+                for e in items:
+                    return e["_id"]
+            return None
+        with self.lock:
+            if self.index is None:
+                self.index = self.build()
+            return self.index.get(name)
+
+    def add(self, name, id):
+        with self.lock:
+            if self.index is not None:
+                self.index[name] = id
+
+    def reset(self):
+        with self.lock:
+            self.index = None
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+import threading
+import time
+
+MISS = object()
+
+class LookupCache():
+    """LRU cache with per-entry TTL for CTIS name -> _id lookups, keyed by (type, natural key)"""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, type: str, key):
+        with self.lock:
+            entry = self.items.get((type, key))
+            if entry is None:
+                return MISS
+            value, expires = entry
+            if self.ttl and expires < time.monotonic():
+                del self.items[(type, key)]
+                return MISS
+            self.items.move_to_end((type, key))
+            return value
+
+    def put(self, type: str, key, value):
+        with self.lock:
+            self.items[(type, key)] = (value, time.monotonic() + self.ttl)
+            self.items.move_to_end((type, key))
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def invalidate(self, type: str, key):
+        with self.lock:
+            self.items.pop((type, key), None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
@@ -0,0 +1,72 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+import multiprocessing
+import threading
+
+from metrics import metrics
+from .cache import LookupCache, MISS
+
+def fragment_hash(html):
+    return hashlib.sha1(html.encode()).hexdigest()
+
+def html_to_text(html):
+    # imported on first use, runs that write no entity never pay for it
+    import html2text
+    return html2text.html2text(html)
+
+class FragmentConverter():
+    """HTML to text conversion of reference fragments, memoized by fragment hash.
+
+    Fragments recur across entities, documents and alerts, so each distinct one is converted
+    once. prewarm() sends batches of at least min_batch fragments to a process pool, keeping
+    the CPU-bound conversion off the threads doing CTIS I/O.
+    """
+
+    def __init__(self, max_size: int = 10000, processes: int = 0, min_batch: int = 64):
+        self.cache = LookupCache(max_size, 0)
+        # daemonic processes, e.g. multiprocessing.Pool workers, can't have children of their own
+        self.processes = 0 if multiprocessing.current_process().daemon else processes
+        self.min_batch = min_batch
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def convert(self, html, digest=None):
+        digest = digest or fragment_hash(html)
+        text = self.cache.get("text", digest)
+        if text is not MISS:
+            metrics.inc("html2text_cache_total", result="hit")
+            return text
+        metrics.inc("html2text_cache_total", result="miss")
+        with metrics.timer("html2text_seconds"):
+            text = html_to_text(html)
+        self.cache.put("text", digest, text)
+        return text
+
+    def prewarm(self, fragments):
+        missing = {}
+        for html in fragments:
+            digest = fragment_hash(html)
+            if digest not in missing and self.cache.get("text", digest) is MISS:
+                missing[digest] = html
+        if not self.processes or len(missing) < self.min_batch:
+            return
+        with metrics.timer("html2text_batch_seconds"):
+            texts = self.get_pool().map(html_to_text, missing.values(), chunksize=max(1, len(missing) // (self.processes * 4)))
+            for digest, text in zip(missing, texts):
+                self.cache.put("text", digest, text)
+        metrics.inc("html2text_pooled_total", len(missing))
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                logging.info(f"Starting {self.processes} html2text worker processes")
+                # spawned, the writer threads may hold locks a forked child would inherit
+                self.pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+            return self.pool
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
@@ -1,12 +1,44 @@
 from .source import NotificationSource
-from config import Config
+from .cache import LookupCache, MISS
+from .aliases import AliasResolver
+from .mappings import EntityMappings
+from .convert import FragmentConverter, fragment_hash
+from config import Config, Tenant
+from metrics import metrics
+from ratelimit import limits
+import logging
+import threading
+import time
 import requests
-import html2text 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from enum import Enum
 import urllib.parse
+import json
 import random
 import string
 
+# encoded size of the where parameter of one $in query: gunicorn rejects request lines
+# past 4094 bytes by default, nginx past 8K, and paging and projection need room too
+IN_QUERY_BYTES = 3000
+
+# collections without a natural key, CTIS can't answer a repeated POST with 409 there
+UNKEYED = ("/x-dossiers",)
+
+def in_chunks(values):
+    # splits values into $in lists whose URL-encoded where stays within IN_QUERY_BYTES
+    chunk, size = [], 0
+    for value in values:
+        # the value's quoted JSON plus the encoded ", " separating it from the next one
+        length = len(urllib.parse.quote(json.dumps(value))) + 6
+        if chunk and size + length > IN_QUERY_BYTES:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(value)
+        size += length
+    if chunk:
+        yield chunk
+
 class ReqStat(Enum):
     NEW = 1
     OLD = 2
@@ -17,40 +49,123 @@ class CTIS():
     headers = {}
     url = ""
 
-    def __init__(self, url: str, username: str, password: str):
+    def __init__(self, url: str, username: str, password: str, index=None):
         self.url = url
-        self.CTIS_login(username, password)
+        self.index = index
+        self.mappings = EntityMappings(Config["mappings"]["entities"])
+        self.username = username
+        self.password = password
+        self.login_lock = threading.Lock()
+        self.identity_lock = threading.Lock()
+        self.session = self.make_session()
+        cache_opts = Config.get("cache", {})
+        self.cache = LookupCache(cache_opts.get("max_size", 10000), cache_opts.get("ttl", 3600))
+        # the fragment index only exists to feed description merges
+        self.merge_descriptions = Config.get("sync", {}).get("merge_descriptions", False)
+        convert_opts = Config.get("html2text", {})
+        # tenants already run in tenant_processes processes, a pool each would multiply them
+        processes = 0 if Tenant else convert_opts.get("processes", 2)
+        self.converter = FragmentConverter(convert_opts.get("cache_size", 10000), processes, convert_opts.get("min_batch", 64))
+        self.identities = AliasResolver(self, "/identities", Config["ctis"].get("alias_lookup", "index"), Config["ctis"].get("page_size", 1000))
+        # the login waits for the first request, runs without new alerts never need it
 
-    def set_xsources(self, json_query):
-        if not Config["xsources"] or "ALL" in Config["xsources"]:
-            json_query[0]["x-sources"].append(
-                    {
-                        "source_name": "IOC_Private",
-                        "classification": 0,
-                        "releasability": 0,
-                        "tlp": 0
-                    })
-        else:
-            for src in Config["xsources"]:
+    def make_session(self):
+        opts = Config["ctis"]
+        self.timeout = (opts.get("connect_timeout", 10), opts.get("read_timeout", 60))
+        # with the rate limiter on, request() retries 429/503 itself, so the backoff is spent
+        # outside the endpoint's slot and every rejected attempt reaches the limiter
+        self.overload_retries = opts.get("retries", 5) if limits.enabled else 0
+        self.backoff_factor = opts.get("backoff_factor", 0.5)
+
+        def adapter(methods):
+            retry = Retry(
+                total=opts.get("retries", 5),
+                backoff_factor=self.backoff_factor,
+                status_forcelist=[500, 502, 504] if limits.enabled else [429, 500, 502, 503, 504],
+                allowed_methods=methods,
+                # urllib3 retries 429/503 carrying Retry-After even outside status_forcelist
+                respect_retry_after_header=not limits.enabled,
+                raise_on_status=False
+            )
+            return HTTPAdapter(pool_connections=opts.get("pool_size", 10), pool_maxsize=opts.get("pool_size", 10), max_retries=retry)
+
+        session = requests.Session()
+        # a POST may have been applied before a 5xx or timeout, its retry is answered with 409
+        # and the existing _id; documents without a natural key would be created twice
+        session.mount("http://", adapter(Retry.DEFAULT_ALLOWED_METHODS | {"POST"}))
+        session.mount("https://", adapter(Retry.DEFAULT_ALLOWED_METHODS | {"POST"}))
+        for endpoint in UNKEYED:
+            # requests picks the adapter with the longest matching prefix
+            session.mount(self.url + endpoint, adapter(Retry.DEFAULT_ALLOWED_METHODS))
+        return session
+
+    def login(self):
+        with self.login_lock:
+            if not self.headers:
+                self.CTIS_login(self.username, self.password)
+
+    def request(self, method, url, headers=None, **kwargs):
+        if not self.headers:
+            self.login()
+        sent = self.headers
+        endpoint = "/" + url.split("?")[0].strip("/").split("/")[0]
+        with metrics.timer("ctis_http_request_seconds", method=method, endpoint=endpoint):
+            response = self.send(method, url, endpoint, {**sent, **(headers or {})}, **kwargs)
+        if response.status_code == 401:
+            logging.info("CTIS token expired, logging in again")
+            with self.login_lock:
+                # another thread may have refreshed the token already
+                if self.headers is sent:
+                    self.CTIS_login(self.username, self.password)
+            response = self.send(method, url, endpoint, {**self.headers, **(headers or {})}, **kwargs)
+        status = str(response.status_code) if response.status_code in (200, 201, 409) else "other"
+        metrics.inc("ctis_http_responses_total", method=method, endpoint=endpoint, status=status)
+        return response
+
+    def send(self, method, url, endpoint, headers, **kwargs):
+        # retried for the same methods as the adapter this URL goes through, see make_session
+        retry = self.session.get_adapter(self.url + url).max_retries
+        for attempt in range(self.overload_retries + 1):
+            with limits.slot("ctis" + endpoint) as slot:
+                response = self.session.request(method, self.url + url, headers=headers, timeout=self.timeout, **kwargs)
+                slot.overloaded = response.status_code in (429, 503)
+                # urllib3 retries of 5xx and connection errors include their backoff
+                slot.sample = not response.raw.retries.history
+            if not slot.overloaded or attempt == self.overload_retries or method not in retry.allowed_methods:
+                return response
+            delay = retry.get_retry_after(response.raw) or self.backoff_factor * 2 ** attempt
+            logging.warning(f"CTIS {method} {endpoint} got {response.status_code}, retrying in {delay:.1f}s")
+            metrics.inc("ctis_http_retries_total", endpoint=endpoint, status=response.status_code)
+            time.sleep(delay)
+
+    def resolve_xsources(self, names):
+        # resolved once per alert, every object of the alert shares the result
+        xsources = []
+        if names and "ALL" not in names:
+            for src in names:
                 if not self.check_xsource_exists(src): continue
-                json_query[0]["x-sources"].append(
+                xsources.append(
                         {
                             "source_name": src,
                             "classification": 0,
                             "releasability": 0,
                             "tlp": 0
                         })
-        if not json_query[0]["x-sources"]:
-            json_query[0]["x-sources"].append(
+        if not xsources:
+            xsources.append(
                     {
                         "source_name": "IOC_Private",
                         "classification": 0,
                         "releasability": 0,
                         "tlp": 0
                     })
+        return xsources
 
-    def do_req(self, url, json):
-        response = requests.post(self.url + url, headers = self.headers, json = json)
+    def set_xsources(self, json_query, xsources):
+        json_query[0]["x-sources"] += xsources
+
+    def do_req(self, url, json, key=None):
+        response = self.request("POST", url, json = json)
         ok = ReqStat.NEW
         if response.status_code == 201:
             if "relationships" in url:
@@ -64,19 +179,77 @@ class CTIS():
                 res = response.json()["_error"]["message"]["_id"]
             ok = ReqStat.OLD
         else:
-            res = response.json()
+            try:
+                res = response.json()
+            except ValueError:
+                # a proxy or server error page rather than an Eve error
+                res = f"HTTP {response.status_code}: {response.text[:200]}"
             ok = ReqStat.ERR
 
+        self.remember(url, key, ok, res)
         return ok, res
-    
+
+    def remember(self, url, key, ok, res):
+        if not key:
+            return
+        if ok == ReqStat.ERR:
+            self.cache.invalidate(url, key)
+        else:
+            self.cache.put(url, key, res)
+
+    @metrics.timed("ctis_call_seconds")
+    def do_bulk(self, url, items):
+        if len(items) == 1:
+            items[0].resolve(*self.do_req(url, [items[0].doc], items[0].key))
+            return
+        response = self.request("POST", url, json = [item.doc for item in items])
+        if response.status_code != 201:
+            self.resolve_rejected(url, items, response)
+            return
+        body = response.json()
+        for item, created in zip(items, body.get("_items", [body])):
+            self.remember(url, item.key, ReqStat.NEW, created if "relationships" in url else created["_id"])
+            item.resolve(ReqStat.NEW, created if "relationships" in url else created["_id"])
+
+    def resolve_rejected(self, url, items, response):
+        # a conflict or validation issue on any document rejects the whole array; the
+        # per-document statuses tell which ones were the problem, only the others are resent
+        try:
+            statuses = response.json().get("_items")
+        except ValueError:
+            statuses = None
+        if not isinstance(statuses, list) or len(statuses) != len(items):
+            # no per-document statuses, replay one by one to get each document's own NEW/OLD/ERR
+            for item in items:
+                item.resolve(*self.do_req(url, [item.doc], item.key))
+            return
+        resend = []
+        for item, status in zip(items, statuses):
+            if status.get("_status") == "OK":
+                resend.append(item)
+                continue
+            existing = (status.get("_error") or {}).get("message")
+            if (status.get("_error") or {}).get("code") == 409 and isinstance(existing, dict) and "_id" in existing:
+                ok, res = ReqStat.OLD, status if "relationships" in url else existing["_id"]
+            else:
+                ok, res = ReqStat.ERR, status
+            self.remember(url, item.key, ok, res)
+            item.resolve(ok, res)
+        if len(resend) == len(items):
+            for item in items:
+                item.resolve(*self.do_req(url, [item.doc], item.key))
+        elif resend:
+            self.do_bulk(url, resend)
+
+    def batch(self):
+        return BatchWriter(self, Config["ctis"].get("batch_size", 50))
+
+    @metrics.timed("ctis_call_seconds")
     def check_aliases(self, entity_url, name):
-        res = requests.get(self.url + entity_url, headers = self.headers, json = []).json()["_items"]
-        for e in res:
-            if "aliases" in e and name in e["aliases"]:
-                return e["_id"]
-        return None
+        return self.identities.resolve(name)
 
-    def add_relationship_al_vic(self, rel_type, src, src_type, dst, dst_type):
+    @metrics.timed("ctis_call_seconds")
+    def add_relationship_al_vic(self, rel_type, src, src_type, dst, dst_type, batch=None):
         json_query = [
             {
                 "confidence": 100,
@@ -90,12 +263,15 @@ class CTIS():
             }
         ]
 
+        if batch:
+            return batch.add("/relationships", json_query[0], error="Can't create al-vic relationship")
         ok, rel = self.do_req("/relationships", json_query)
         if ok == ReqStat.ERR:
             raise Exception(f"Can't create al-vic relationship {rel}")
         return rel
 
-    def add_relationship(self, rel_type, src, src_type, dst, dst_type):
+    @metrics.timed("ctis_call_seconds")
+    def add_relationship(self, rel_type, src, src_type, dst, dst_type, batch=None):
         json_query = [
             {
                 "confidence": 100,
@@ -108,71 +284,138 @@ class CTIS():
             }
         ]
 
+        if batch:
+            return batch.add("/relationships", json_query[0], error="Can't create relationship")
         ok, rel = self.do_req("/relationships", json_query)
         if ok == ReqStat.ERR:
             raise Exception(f"Can't create relationship {rel}")
         return rel
 
+    @metrics.timed("ctis_call_seconds")
     def add_identity(self, name):
-        res = self.check_aliases("/identities", name)
-        if res != None:
-            return res
-        json_query = [
-            {
-                "confidence": 100,
-                "name": name,
-                "identity_class": "organization",
-                "x-sources": [
-                    {
-                        "source_name": "default",
-                        "classification": 0,
-                        "releasability": 0,
-                        "tlp": 0
-                    }
-                ]
-            }
-        ]
+        return self.add_identities([name])[name]
 
-        ok, identity = self.do_req("/identities", json_query)
-        if ok == ReqStat.ERR:
-            raise Exception(f"Can't create identity {name}")
-        return identity
+    @metrics.timed("ctis_call_seconds")
+    def add_identities(self, names):
+        """Resolves organisation names to identity _ids, creating the missing ones in one bulk POST"""
+        res = {}
+        missing = []
+        # serialized so that workers sharing an owner never both create it
+        with self.identity_lock:
+            for name in dict.fromkeys(names):
+                id = self.entity_id("/identities", name)
+                if id is None:
+                    id = self.check_aliases("/identities", name)
+                    if id is not None:
+                        self.remember_identity(name, id)
+                if id is None:
+                    missing.append(name)
+                else:
+                    res[name] = id
+            if not missing:
+                return res
+            with self.batch() as batch:
+                items = {name: batch.add("/identities", self.identity_document(name), name, error=f"Can't create identity {name}") for name in missing}
+            for name, item in items.items():
+                res[name] = item.result()
+                self.remember_identity(name, res[name])
+        return res
+
+    def identity_document(self, name):
+        return {
+            "confidence": 100,
+            "name": name,
+            "identity_class": "organization",
+            "x-sources": [
+                {
+                    "source_name": "default",
+                    "classification": 0,
+                    "releasability": 0,
+                    "tlp": 0
+                }
+            ]
+        }
+
+    def remember_identity(self, name, id):
+        # kept in the state store too, so owners are not looked up again on the next runs
+        self.cache.put("/identities", name, id)
+        self.identities.add(name, id)
+        if self.index is not None:
+            self.index.remember_entity("/identities", name, id)
 
     def do_patch(self, url, etag, json):
-        hdr = self.headers.copy()
-        hdr["If-Match"] = etag
-        return requests.patch(self.url + url, headers=hdr, json=json).json()
+        return self.request("PATCH", url, headers={"If-Match": etag}, json=json).json()
 
     def do_get(self, url):
-        return requests.get(self.url + url, headers=self.headers).json()
+        return self.request("GET", url).json()
 
-    def add_entity(self, param, type, description):
-        if type not in Config["mappings"]["entities"].keys():
-            with open("/files/missing_entities.txt", 'a+') as f:
-                f.write(f"Entity type doesn't exist in mapping: {type}; param: {param}; description: {description}\n")
+    @metrics.timed("ctis_call_seconds")
+    def add_entity(self, param, type, description, xsources, batch=None):
+        mapping = self.mappings.get(type)
+        if mapping is None:
+            self.mappings.report_missing(type, param, description)
             return None
-        description = f"RF type: {type}\n" + html2text.html2text(description)
-        json_query = [
-            {
-                "x-sources": [
-               ],
-            }
-        ]
-        self.set_xsources(json_query)
+        endpoint = mapping.endpoint
+        fragment = fragment_hash(description)
+        known = self.entity_id(endpoint, param)
+        if known is not None:
+            if self.merge_descriptions and self.index is not None and not self.index.seen_fragment(endpoint, param, fragment):
+                self.merge_description(endpoint, param, known, mapping, description, fragment)
+            return BatchItem.done(known) if batch else known
+        fragment_html = description
+        description = f"RF type: {type}\n" + self.converter.convert(description, fragment)
+        json_query = [mapping.document(param, description, xsources)]
 
-        if "class" in Config["mappings"]["entities"][type].keys():
-            json_query[0]["identity_class"] = Config["mappings"]["entities"][type]["class"] 
-        if "description" in Config["mappings"]["entities"][type].keys():
-            json_query[0][Config["mappings"]["entities"][type]["description"]] = description.replace('\n', '\r\n')
-        if "param" in Config["mappings"]["entities"][type].keys():
-            json_query[0][Config["mappings"]["entities"][type]["param"]] = param
+        def created(ok, entity, doc=None):
+            if ok == ReqStat.ERR or self.index is None:
+                return
+            self.index.remember_entity(endpoint, param, entity)
+            if not self.merge_descriptions:
+                return
+            # a batch sends only the first document queued for an entity
+            if ok == ReqStat.NEW and (doc is None or doc is json_query[0]):
+                self.index.add_fragment(endpoint, param, fragment)
+            else:
+                # created before we indexed it, its description may lack this fragment
+                self.merge_description(endpoint, param, entity, mapping, fragment_html, fragment)
 
-        ok, entity = self.do_req("/" + Config["mappings"]["entities"][type]["type"], json_query)
+        if batch:
+            return batch.add(endpoint, json_query[0], param, error=f"Can't create entity of type {type}:", on_done=created)
+        ok, entity = self.do_req(endpoint, json_query, param)
         if ok == ReqStat.ERR:
             raise Exception(f"Can't create entity {entity} of type {type}")
+        created(ok, entity)
         return entity
 
-    def add_dossier(self, name, originator, text, owners):
+    def entity_id(self, endpoint, param):
+        res = self.cache.get(endpoint, param)
+        if res is not MISS:
+            return res
+        if self.index is None:
+            return None
+        res = self.index.entity_id(endpoint, param)
+        if res is not None:
+            self.cache.put(endpoint, param, res)
+        return res
+
+    def merge_description(self, endpoint, param, id, mapping, fragment_html, fragment):
+        if not mapping.description:
+            self.index.add_fragment(endpoint, param, fragment)
+            return
+        field = mapping.description
+        text = self.converter.convert(fragment_html, fragment).strip()
+        cur = self.do_get(f"{endpoint}/{id}")
+        current = cur.get(field, "") or ""
+        # only patch when the fragment brings text the entity doesn't already have
+        if text and text.replace('\n', '\r\n') not in current:
+            res = self.do_patch(f"{endpoint}/{id}", cur["_etag"], {field: current + "\r\n\r\n" + text.replace('\n', '\r\n')})
+            if res.get("_status") != "OK":
+                logging.warning(f"Can't merge description into {endpoint}/{id}: {res}")
+                return
+        self.index.add_fragment(endpoint, param, fragment)
+
+    @metrics.timed("ctis_call_seconds")
+    def add_dossier(self, name, originator, text, owners, xsources):
         json_query = [
             {
                 "name": name,
@@ -186,7 +429,7 @@ class CTIS():
             }
         ]
 
-        self.set_xsources(json_query)
+        self.set_xsources(json_query, xsources)
 
         ok, dossier = self.do_req("/x-dossiers", json_query)
         if ok == ReqStat.ERR:
@@ -201,7 +444,8 @@ class CTIS():
                 raise Exception(f"Can't create dossier: {dossier}")
         return dossier
 
-    def add_alert(self, id, name, message):
+    @metrics.timed("ctis_call_seconds")
+    def add_alert(self, id, name, message, xsources, existing_ok=False):
         json_query = [
             {
                 "entity_type": "report",
@@ -215,12 +459,12 @@ class CTIS():
                 ]
             }
         ]
-        self.set_xsources(json_query)
+        self.set_xsources(json_query, xsources)
 
-        ok, alert = self.do_req("/alerts", json_query)
+        ok, alert = self.do_req("/alerts", json_query, name + ' - ' + str(id))
         if ok == ReqStat.ERR:
             raise Exception(f"Can't create alert: {alert}")
-        if ok == ReqStat.OLD:
+        if ok == ReqStat.OLD and not existing_ok:
             return None
         return alert
 
@@ -237,7 +481,11 @@ class CTIS():
          cur["parameter_value"]["list_values"] += new
          self.do_patch(f"/settings/{id}", etag, cur)
 
+    @metrics.timed("ctis_call_seconds")
     def check_alert_exists(self, id, title):
+        res = self.cache.get("/alerts", title + ' - ' + id)
+        if res is not MISS:
+            return bool(res)
         cur = self.do_get(f"/alerts?where=%7B%22title%22%3A%20%22{urllib.parse.quote_plus(title + ' - ' + id)}%22%7D&page=1&max_results=25")
         try:
             if cur["_items"]:
@@ -247,27 +495,82 @@ class CTIS():
         except:
             return False
 
+    def find(self, endpoint, where, field):
+        page = 1
+        while True:
+            query = f"{endpoint}?where={urllib.parse.quote(json.dumps(where))}&projection={urllib.parse.quote(json.dumps({field: 1}))}"
+            response = self.request("GET", query + f"&page={page}&max_results={Config['ctis'].get('page_size', 1000)}")
+            if response.status_code != 200:
+                raise requests.HTTPError(f"{endpoint} query returned {response.status_code}", response=response)
+            cur = response.json()
+            yield from cur.get("_items", [])
+            if "next" not in cur.get("_links", {}):
+                return
+            page += 1
+
+    @metrics.timed("ctis_call_seconds")
+    def check_many_exist(self, endpoint, field, values, cache_type=None):
+        """Resolves values of field with paged $in queries, returns value -> _id or False.
+
+        Results are put in the lookup cache under cache_type (default endpoint), so the
+        single check_*_exists calls that follow are answered without a request. Values of
+        a query that failed are left out, their single checks ask CTIS one by one.
+        """
+        res = {}
+        for chunk in in_chunks(dict.fromkeys(values)):
+            found = {}
+            try:
+                for item in self.find(endpoint, {field: {"$in": chunk}}, field):
+                    found.setdefault(item.get(field), item["_id"])
+            except (requests.RequestException, ValueError) as e:
+                logging.warning(f"Bulk check of {len(chunk)} {endpoint} values failed, checking them one by one: {e}")
+                continue
+            for value in chunk:
+                res[value] = found.get(value, False)
+                self.cache.put(cache_type or endpoint, value, res[value])
+        return res
+
+    def check_alerts_exist(self, alerts):
+        # alerts are (id, title) pairs
+        return self.check_many_exist("/alerts", "title", [title + ' - ' + id for id, title in alerts])
+
+    def check_eeis_exist(self, rules):
+        # rules are (id, name) pairs
+        return self.check_many_exist("/eeis", "name", [name + ' - ' + id for id, name in rules])
+
+    def check_xsources_exist(self, names):
+        return self.check_many_exist("/eeis", "name", names, "x-sources")
+
+    @metrics.timed("ctis_call_seconds")
     def check_eei_exists(self, id, title):
+        res = self.cache.get("/eeis", title + ' - ' + id)
+        if res is not MISS:
+            return res
         cur = self.do_get(f"/eeis?where=%7B%22name%22%3A%20%22{urllib.parse.quote_plus(title + ' - ' + id)}%22%7D&page=1&max_results=25")
         try:
             if cur["_items"]:
+                self.cache.put("/eeis", title + ' - ' + id, cur["_items"][0]["_id"])
                 return cur["_items"][0]["_id"]
             else:
                 return False
         except:
             return False
 
+    @metrics.timed("ctis_call_seconds")
     def check_xsource_exists(self, name):
+        res = self.cache.get("x-sources", name)
+        if res is not MISS:
+            return res
         cur = self.do_get(f"/eeis?where=%7B%22name%22%3A%20%22{name}%22%7D&page=1&max_results=25")
         try:
-            if cur["_items"]:
-                return cur["_items"][0]["_id"]
-            else:
-                return False
+            res = cur["_items"][0]["_id"] if cur["_items"] else False
         except:
             return False
+        self.cache.put("x-sources", name, res)
+        return res
 
-    def add_eei(self, id, name, url, author):
+    @metrics.timed("ctis_call_seconds")
+    def add_eei(self, id, name, url, author, xsources):
         old_eei = self.check_eei_exists(id, name)
         if old_eei:
             return old_eei
@@ -280,14 +583,107 @@ class CTIS():
                 ]
             }
         ]
-        self.set_xsources(json_query)
+        self.set_xsources(json_query, xsources)
 
-        ok, eei = self.do_req("/eeis", json_query)
+        ok, eei = self.do_req("/eeis", json_query, name + ' - ' + id)
         if ok == ReqStat.ERR:
             raise Exception(f"Can't create eei: {eei}")
         return eei
 
     def CTIS_login(self, user, password):
         #response = requests.post(f"{self.url}/api/auth/login", json={"username": user, "password": password})
-        response = requests.get(f"{self.url}/login", auth=(user, password))
+        with metrics.timer("ctis_login_seconds"):
+            response = self.session.get(f"{self.url}/login", auth=(user, password), timeout=self.timeout)
+        response.raise_for_status()
         self.headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': 'Bearer ' + response.json()["data"]["access_token"]}
+
+
+class BatchItem():
+
+    def __init__(self, url, doc, key=None, error="Can't create"):
+        self.url = url
+        self.doc = doc
+        self.key = key
+        self.error = error
+        self.ok = None
+        self.res = None
+        self.checked = False
+        self.callbacks = []
+
+    @staticmethod
+    def done(res):
+        item = BatchItem(None, None)
+        item.ok, item.res = ReqStat.OLD, res
+        return item
+
+    def resolve(self, ok, res):
+        self.ok, self.res = ok, res
+        for callback in self.callbacks:
+            try:
+                callback(ok, res, self.doc)
+            except:
+                logging.exception(f"Post-write step for {self.url} failed")
+
+    def on_done(self, callback):
+        if self.ok is None:
+            self.callbacks.append(callback)
+        else:
+            # already flushed, e.g. by the add() that filled the batch
+            callback(self.ok, self.res, self.doc)
+
+    def on_error(self, callback):
+        # the caller handles this item's failure, closing the batch won't raise it
+        self.checked = True
+        self.on_done(lambda ok, res, doc: ok == ReqStat.ERR and callback(f"{self.error} {res}"))
+
+    def result(self):
+        if self.ok is None:
+            raise Exception(f"Batch item for {self.url} was not flushed")
+        self.checked = True
+        if self.ok == ReqStat.ERR:
+            raise Exception(f"{self.error} {self.res}")
+        return self.res
+
+class BatchWriter():
+    """Collects documents per endpoint and sends them as multi-item POSTs.
+
+    Errors on items nobody called result() on are raised when the writer is closed.
+    """
+
+    def __init__(self, ctis, size: int):
+        self.ctis = ctis
+        self.size = size
+        self.queues = {}
+        self.failed = []
+
+    def add(self, url, doc, key=None, error="Can't create", on_done=None):
+        queue = self.queues.setdefault(url, {})
+        # the same natural key twice in one array would make CTIS reject the whole batch
+        qkey = key if key else id(doc)
+        if qkey not in queue:
+            queue[qkey] = BatchItem(url, doc, key, error)
+        item = queue[qkey]
+        if on_done:
+            item.on_done(on_done)
+        if len(queue) >= self.size:
+            self.flush(url)
+        return item
+
+    def flush(self, url=None):
+        for u in ([url] if url else list(self.queues.keys())):
+            items = list(self.queues.pop(u, {}).values())
+            for i in range(0, len(items), self.size):
+                self.ctis.do_bulk(u, items[i:i + self.size])
+            self.failed += [item for item in items if item.ok == ReqStat.ERR]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            return False
+        self.flush()
+        for item in self.failed:
+            if not item.checked:
+                item.result()
+        return False
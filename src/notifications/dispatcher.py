@@ -0,0 +1,82 @@
+import logging
+import queue
+import threading
+import time
+
+from .slack import SlackNotification
+
+# Slack rejects section blocks longer than 3000 characters
+MAX_DIGEST_CHARS = 2900
+
+class NotificationDispatcher():
+    """Background Slack sender: info messages are coalesced into digests flushed on
+    size or age, errors are sent one by one, fatal errors bypass the queue."""
+
+    def __init__(self, url: str, flush_size: int = 20, flush_interval: float = 60):
+        self.url = url
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="slack-dispatcher", daemon=True)
+        self.thread.start()
+
+    def info(self, info: str):
+        self.queue.put(("info", info))
+
+    def error(self, context: str, error: str, fatal: bool = False):
+        if fatal:
+            # whatever is still queued goes first so the digest is not lost if we die right after
+            self.drain()
+            if not SlackNotification.send_error_notification(self.url, context, error, fatal):
+                logging.error("Failed to send error notification to Slack workspace")
+            return
+        self.queue.put(("error", (context, error)))
+
+    def send_digest(self, infos):
+        chunk = []
+        size = 0
+        for info in infos:
+            if chunk and size + len(info) > MAX_DIGEST_CHARS:
+                self.post_info(chunk)
+                chunk, size = [], 0
+            chunk.append(info)
+            size += len(info) + 1
+        if chunk:
+            self.post_info(chunk)
+
+    def post_info(self, chunk):
+        if not SlackNotification.send_info_notification(self.url, "\n".join(chunk)):
+            logging.error("Failed to send info notification to Slack workspace")
+
+    def run(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                kind, payload = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                kind, payload = "flush", None
+            if kind == "info":
+                pending.append(payload)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            try:
+                if kind == "error":
+                    if not SlackNotification.send_error_notification(self.url, payload[0], payload[1], False):
+                        logging.error("Failed to send error notification to Slack workspace")
+                if pending and (kind in ("flush", "drain") or len(pending) >= self.flush_size or time.monotonic() >= deadline):
+                    self.send_digest(pending)
+                    pending, deadline = [], None
+            except:
+                # never let a bad message kill the sender thread
+                logging.exception("Failed to dispatch Slack notifications")
+                pending, deadline = [], None
+            if kind == "drain":
+                payload.set()
+
+    def drain(self, timeout: float = 30):
+        done = threading.Event()
+        self.queue.put(("drain", done))
+        if not done.wait(timeout):
+            logging.error("Timed out draining Slack notifications")
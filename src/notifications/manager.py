@@ -1,16 +1,34 @@
-import logging
+import atexit
+import threading
 
-from config import Config
-from .slack import SlackNotification
-from .ctis import CTIS
+from config import Config, Tenant
+from .dispatcher import NotificationDispatcher
 
 class NotificationManager():
+    dispatcher = None
+    lock = threading.Lock()
+
+    def get_dispatcher():
+        with NotificationManager.lock:
+            if NotificationManager.dispatcher is not None:
+                return NotificationManager.dispatcher
+            opts = Config["slack"]
+            NotificationManager.dispatcher = NotificationDispatcher(opts["url"], opts.get("flush_size", 20), opts.get("flush_interval", 60))
+            atexit.register(NotificationManager.flush)
+            return NotificationManager.dispatcher
+
     def send_error_notification(context: str, error: str, fatal: bool = False):
+        if Tenant:
+            context = f"[{Tenant}] {context}"
         if "slack" in Config:
-            if not SlackNotification.send_error_notification(Config["slack"]["url"], context, error, fatal):
-                logging.error("Failed to send error notification to Slack workspace")
+            NotificationManager.get_dispatcher().error(context, error, fatal)
 
     def send_info_notification(info: str):
+        if Tenant:
+            info = f"[{Tenant}] {info}"
         if "slack" in Config:
-            if not SlackNotification.send_info_notification(Config["slack"]["url"], info):
-                logging.error("Failed to send info notification to Slack workspace")
+            NotificationManager.get_dispatcher().info(info)
+
+    def flush():
+        if NotificationManager.dispatcher is not None:
+            NotificationManager.dispatcher.drain()
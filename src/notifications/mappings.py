@@ -0,0 +1,54 @@
+from collections import Counter
+import logging
+import threading
+
+class EntityMapping():
+    """One RF entity type compiled into its CTIS endpoint and payload template"""
+
+    def __init__(self, rf_type: str, conf: dict):
+        self.rf_type = rf_type
+        self.type = conf["type"]
+        self.endpoint = "/" + conf["type"]
+        self.param = conf.get("param")
+        self.description = conf.get("description")
+        self.template = {}
+        if "class" in conf:
+            self.template["identity_class"] = conf["class"]
+
+    def document(self, param, description, xsources):
+        doc = dict(self.template)
+        doc["x-sources"] = list(xsources)
+        if self.description:
+            doc[self.description] = description.replace('\n', '\r\n')
+        if self.param:
+            doc[self.param] = param
+        return doc
+
+class EntityMappings():
+    """Config mappings.entities compiled once; unmapped RF types are counted and reported once per run"""
+
+    def __init__(self, conf: dict):
+        self.mappings = {rf_type: EntityMapping(rf_type, c) for rf_type, c in (conf or {}).items()}
+        self.lock = threading.Lock()
+        self.missing = Counter()
+        self.examples = {}
+
+    def get(self, rf_type):
+        return self.mappings.get(rf_type)
+
+    def report_missing(self, rf_type, param, description):
+        with self.lock:
+            self.missing[rf_type] += 1
+            self.examples.setdefault(rf_type, (param, description))
+
+    def write_missing(self, path):
+        with self.lock:
+            missing, examples = self.missing, self.examples
+            self.missing, self.examples = Counter(), {}
+        if not missing:
+            return
+        with open(path, 'a+') as f:
+            for rf_type, count in missing.most_common():
+                param, description = examples[rf_type]
+                f.write(f"Entity type doesn't exist in mapping: {rf_type}; occurrences: {count}; example param: {param}; description: {description}\n")
+        logging.info(f"{sum(missing.values())} entities of {len(missing)} unmapped types skipped, see {path}")
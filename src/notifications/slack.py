@@ -1,5 +1,6 @@
 from datetime import datetime
 import logging
+import time
 import requests
 from typing import Dict
 import json
@@ -7,8 +8,18 @@ import json
 from .source import NotificationSource
 
 class SlackNotification(NotificationSource):
-    def _post_webhook(body: Dict, url: str) -> bool:
-        r = requests.post(url, json=body)
+    def _post_webhook(body: Dict, url: str, retries: int = 5) -> bool:
+        try:
+            r = requests.post(url, json=body, timeout=10)
+        except requests.RequestException as e:
+            logging.error(f"Error sending Slack notification: {e}")
+            return False
+        if r.status_code == 429 and retries > 0:
+            # Slack webhooks allow about one message per second and say how long to back off
+            delay = float(r.headers.get("Retry-After", 1))
+            logging.warning(f"Slack rate limited, retrying in {delay}s")
+            time.sleep(delay)
+            return SlackNotification._post_webhook(body, url, retries - 1)
         if r.status_code != 200:
             logging.error(
                 f"Error sending Slack notification ({r.status_code}): {r.content.decode()}")
@@ -0,0 +1,139 @@
+from collections import deque
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from config import Config
+from metrics import metrics
+
+class Outcome():
+    # set overloaded to tell the limiter how a call went, exceptions count as overload by default;
+    # clear sample to keep a call that includes retry backoff out of the latency window
+    overloaded = None
+    sample = True
+
+class AIMDLimiter():
+    """Adaptive in-flight limit for one endpoint.
+
+    The limit grows by `increase` per limit-worth of healthy calls and is multiplied by
+    `decrease` on overload (429/503, connection errors) or when the p95 latency of the last
+    `window` calls goes past `latency_factor` times its healthy baseline.
+    """
+
+    def __init__(self, name: str, initial: float = 4, min_limit: float = 1, max_limit: float = 64, increase: float = 1,
+                 decrease: float = 0.5, window: int = 50, latency_factor: float = 2):
+        self.name = name
+        self.limit = float(initial)
+        self.min = min_limit
+        self.max = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.latencies = deque(maxlen=window)
+        self.samples = 0
+        self.baseline = None
+        self.since_cut = int(initial)
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+        outcome = Outcome()
+        start = time.perf_counter()
+        try:
+            yield outcome
+        except:
+            if outcome.overloaded is None:
+                outcome.overloaded = True
+            raise
+        finally:
+            self.release(time.perf_counter() - start if outcome.sample else None, bool(outcome.overloaded))
+
+    def release(self, latency, overloaded):
+        with self.cond:
+            self.inflight -= 1
+            self.since_cut += 1
+            if latency is not None:
+                self.latencies.append(latency)
+                self.samples += 1
+            if overloaded:
+                self.cut("overloaded")
+            elif latency is not None and self.samples % self.latencies.maxlen == 0 and self.slow():
+                self.cut(f"p95 latency {self.p95():.2f}s over {self.latency_factor}x baseline {self.baseline:.2f}s")
+            elif self.limit < self.max:
+                before = int(self.limit)
+                self.limit = min(self.max, self.limit + self.increase / self.limit)
+                if int(self.limit) != before:
+                    logging.debug(f"Rate limit {self.name}: raised to {int(self.limit)}")
+            metrics.set("ratelimit_limit", int(self.limit), endpoint=self.name)
+            self.cond.notify_all()
+
+    def p95(self):
+        latencies = sorted(self.latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def slow(self):
+        p95 = self.p95()
+        slow = self.baseline is not None and p95 > self.baseline * self.latency_factor
+        # the baseline follows slowly, a backend that stays slower becomes the norm after a few windows
+        self.baseline = p95 if self.baseline is None else 0.9 * self.baseline + 0.1 * p95
+        return slow
+
+    def cut(self, reason):
+        # calls already in flight when the limit was cut don't cut it again
+        if self.since_cut < int(self.limit):
+            return
+        self.since_cut = 0
+        self.limit = max(self.min, self.limit * self.decrease)
+        metrics.inc("ratelimit_cuts_total", endpoint=self.name)
+        logging.warning(f"Rate limit {self.name}: {reason}, cut to {int(self.limit)} in flight")
+
+    def state(self):
+        with self.cond:
+            p95 = f"{self.p95() * 1000:.0f}ms" if self.latencies else "-"
+            return f"{self.name}: limit {int(self.limit)}, in flight {self.inflight}, p95 {p95}"
+
+class RateController():
+    """One AIMDLimiter per endpoint, shared by every outbound CTIS and RF call.
+
+    Limiters are created on first use from the `ratelimit` config defaults, overridden
+    per endpoint by `ratelimit.endpoints.<name>`.
+    """
+
+    def __init__(self, conf: dict):
+        self.conf = conf
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, name):
+        with self.lock:
+            if name not in self.limiters:
+                opts = {k: v for k, v in self.conf.items() if k not in ("enabled", "endpoints")}
+                opts.update(self.conf.get("endpoints", {}).get(name, {}))
+                self.limiters[name] = AIMDLimiter(name, **opts)
+            return self.limiters[name]
+
+    @property
+    def enabled(self):
+        return self.conf.get("enabled", True)
+
+    @contextmanager
+    def slot(self, name):
+        if not self.enabled:
+            yield Outcome()
+            return
+        with self.limiter(name).slot() as outcome:
+            yield outcome
+
+    def log_state(self):
+        with self.lock:
+            limiters = list(self.limiters.values())
+        for limiter in sorted(limiters, key=lambda l: l.name):
+            logging.info(f"Rate limit {limiter.state()}")
+
+limits = RateController(Config.get("ratelimit", {}))
@@ -0,0 +1,152 @@
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    alert_id TEXT PRIMARY KEY,
+    ctis_id TEXT,
+    title TEXT,
+    triggered TEXT,
+    processed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS alerts_processed_at ON alerts (processed_at);
+CREATE TABLE IF NOT EXISTS objects (
+    alert_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    ctis_id TEXT NOT NULL,
+    step TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_alert_id ON objects (alert_id);
+CREATE TABLE IF NOT EXISTS entities (
+    type TEXT NOT NULL,
+    value TEXT NOT NULL,
+    ctis_id TEXT NOT NULL,
+    seen_at REAL NOT NULL,
+    PRIMARY KEY (type, value)
+);
+CREATE TABLE IF NOT EXISTS entity_fragments (
+    type TEXT NOT NULL,
+    value TEXT NOT NULL,
+    fragment TEXT NOT NULL,
+    PRIMARY KEY (type, value, fragment)
+);
+CREATE TABLE IF NOT EXISTS journal (
+    alert_id TEXT NOT NULL,
+    step TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    ctis_id TEXT NOT NULL,
+    done_at REAL NOT NULL,
+    PRIMARY KEY (alert_id, step)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class StateStore():
+    """SQLite record of processed alerts, the CTIS objects created for them, a journal of
+    the steps done for alerts still in progress and the fingerprints of entities already
+    known to CTIS"""
+
+    def __init__(self, path: str, retention_days: float = 7, entity_retention_days: float = 30):
+        self.path = path
+        self.retention = retention_days * 86400
+        self.entity_retention = entity_retention_days * 86400
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        if "step" not in [c[1] for c in self.db.execute("PRAGMA table_info(objects)")]:
+            self.db.execute("ALTER TABLE objects ADD COLUMN step TEXT")
+
+    def is_processed(self, alert_id: str) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM alerts WHERE alert_id = ?", (alert_id,)).fetchone() is not None
+
+    def mark_processed(self, alert_id: str, ctis_id=None, title=None, triggered=None, objects=None):
+        # objects maps (kind, ctis_id) to the step that created it, if it must be reused on replay
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?, ?)", (alert_id, ctis_id, title, triggered, time.time()))
+                self.db.execute("DELETE FROM objects WHERE alert_id = ?", (alert_id,))
+                self.db.executemany("INSERT INTO objects VALUES (?, ?, ?, ?)", [(alert_id, kind, id, step) for (kind, id), step in (objects or {}).items() if id])
+                self.db.execute("DELETE FROM journal WHERE alert_id = ?", (alert_id,))
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def objects(self, alert_id: str):
+        with self.lock:
+            return self.db.execute("SELECT kind, ctis_id, step FROM objects WHERE alert_id = ?", (alert_id,)).fetchall()
+
+    def journal(self, alert_id: str, step: str, kind: str, ctis_id: str):
+        # None when the object was created concurrently by someone else, nothing to reuse
+        if ctis_id is None:
+            return
+        # committed on its own, before the next CTIS write of the alert is attempted
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)", (alert_id, step, kind, ctis_id, time.time()))
+
+    def journal_steps(self, alert_id: str):
+        with self.lock:
+            return dict(self.db.execute("SELECT step, ctis_id FROM journal WHERE alert_id = ?", (alert_id,)).fetchall())
+
+    def prune(self):
+        cutoff = time.time() - self.retention
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("DELETE FROM objects WHERE alert_id IN (SELECT alert_id FROM alerts WHERE processed_at < ?)", (cutoff,))
+            removed = self.db.execute("DELETE FROM alerts WHERE processed_at < ?", (cutoff,)).rowcount
+            # alerts that never finished and have dropped out of the RF search window
+            self.db.execute("DELETE FROM journal WHERE done_at < ?", (cutoff,))
+            # entities deleted from CTIS would otherwise be skipped forever
+            entity_cutoff = time.time() - self.entity_retention
+            self.db.execute("DELETE FROM entity_fragments WHERE (type, value) IN (SELECT type, value FROM entities WHERE seen_at < ?)", (entity_cutoff,))
+            self.db.execute("DELETE FROM entities WHERE seen_at < ?", (entity_cutoff,))
+            self.db.execute("COMMIT")
+        if removed:
+            logging.info(f"Pruned {removed} alerts older than the retention window from state")
+
+    def entity_id(self, type: str, value: str):
+        with self.lock:
+            row = self.db.execute("SELECT ctis_id FROM entities WHERE type = ? AND value = ?", (type, value)).fetchone()
+        return row[0] if row else None
+
+    def remember_entity(self, type: str, value: str, ctis_id: str):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)", (type, value, ctis_id, time.time()))
+
+    def seen_fragment(self, type: str, value: str, fragment: str) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM entity_fragments WHERE type = ? AND value = ? AND fragment = ?", (type, value, fragment)).fetchone() is not None
+
+    def add_fragment(self, type: str, value: str, fragment: str):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO entity_fragments VALUES (?, ?, ?)", (type, value, fragment))
+
+    def get_meta(self, key: str, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def import_ledger(self, ledger: Path):
+        # one-off migration of the old /files/<date>.txt ledgers
+        ids = [line.strip() for line in open(ledger) if line.strip()]
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("INSERT OR IGNORE INTO alerts (alert_id, processed_at) VALUES (?, ?)", [(id, now) for id in ids])
+            self.db.execute("COMMIT")
+        ledger.unlink()
+        logging.info(f"Imported {len(ids)} alerts from legacy ledger {ledger}")
@@ -0,0 +1,49 @@
+from collections import Counter
+import yaml
+
+class AlertSummary():
+    """Size-capped summary of an alert, filled while its documents are streamed into CTIS"""
+
+    def __init__(self, max_items: int = 25, max_bytes: int = 65536):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.data = {}
+        self.sections = {}
+
+    def section(self, name):
+        if name not in self.sections:
+            self.sections[name] = {"documents": 0, "references": 0, "entities": Counter(), "docs": []}
+        return self.sections[name]
+
+    def add_doc(self, section, title, source, url, authors):
+        sec = self.section(section)
+        sec["documents"] += 1
+        if len(sec["docs"]) >= self.max_items:
+            return None
+        doc = {"title": title, "source": source, "url": url, "authors": authors, "refs": []}
+        sec["docs"].append(doc)
+        return doc
+
+    def add_entity(self, section, doc, name, type):
+        self.section(section)["entities"][type] += 1
+        if doc is not None and len(doc["refs"]) < self.max_items and name not in doc["refs"]:
+            doc["refs"].append(name)
+
+    def add_reference(self, section):
+        self.section(section)["references"] += 1
+
+    def dump(self):
+        out = dict(self.data)
+        for name, sec in self.sections.items():
+            out[name] = {
+                "documents": sec["documents"],
+                "references": sec["references"],
+                "entities": dict(sec["entities"]),
+                "docs": sec["docs"]
+            }
+            if sec["documents"] > len(sec["docs"]):
+                out[name]["docs_omitted"] = sec["documents"] - len(sec["docs"])
+        text = yaml.dump(out)
+        if len(text) > self.max_bytes:
+            text = text[:self.max_bytes] + "\n... (summary truncated)\n"
+        return text
@@ -0,0 +1,98 @@
+"""Multi-tenant entry point: runs the sync of every entry in the config's `tenants` list,
+each in its own process with its own sessions, state and caches, then reports once.
+
+    python3 tenants.py
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import importlib.util
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+from pathlib import Path
+
+logging.basicConfig(
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    level=logging.INFO,
+    datefmt="%Y/%m/%d %H:%M:%S",
+)
+
+def run_tenant(name):
+    # config is only imported once RW_TENANT is set, so this process sees the tenant's config
+    os.environ["RW_TENANT"] = name
+    start = time.perf_counter()
+    try:
+        spec = importlib.util.spec_from_file_location("bridge", Path(__file__).resolve().parent / "RF-CTIS-bridge.py")
+        bridge = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(bridge)
+        try:
+            return {"tenant": name, "ok": True, **bridge.main([])}
+        except:
+            bridge.notify_fatal()
+            raise
+    except:
+        logging.exception(f"Sync of tenant {name} failed")
+        error = traceback.format_exc().strip().splitlines()[-1]
+        return {"tenant": name, "ok": False, "error": error, "seconds": time.perf_counter() - start}
+    finally:
+        # pool workers exit without running atexit handlers
+        if "notifications" in sys.modules:
+            sys.modules["notifications"].NotificationManager.flush()
+
+def run_isolated(name, timeout):
+    # one single-worker pool per tenant: a fresh spawned process on every Python version
+    # (max_tasks_per_child needs 3.11), and a crash or OOM kill only breaks this tenant's pool
+    start = time.perf_counter()
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pid = pool.submit(os.getpid).result()
+        future = pool.submit(run_tenant, name)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            logging.error(f"Sync of tenant {name} still running after {timeout}s, killing it")
+            os.kill(pid, signal.SIGKILL)
+            error = f"timed out after {timeout}s"
+        except BrokenProcessPool:
+            logging.error(f"Process of tenant {name} died")
+            error = "tenant process died"
+    return {"tenant": name, "ok": False, "error": error, "seconds": time.perf_counter() - start}
+
+def report_line(report):
+    if report["ok"]:
+        return f"{report['tenant']}: {report['added']} added / {report['processed']} processed in {report['seconds']:.1f}s"
+    return f"{report['tenant']}: FAILED after {report['seconds']:.1f}s: {report['error']}"
+
+def main():
+    from config import Config
+    from notifications import NotificationManager
+
+    tenants = [tenant["name"] for tenant in Config.get("tenants", [])]
+    if not tenants:
+        logging.error("No tenants configured")
+        return 1
+    processes = min(Config.get("sync", {}).get("tenant_processes", 4), len(tenants))
+    timeout = Config.get("sync", {}).get("tenant_timeout", 3600) or None
+    logging.info(f"Syncing {len(tenants)} tenants in {processes} processes")
+    start = time.perf_counter()
+    # spawned rather than forked, and one process per tenant, so nothing leaks between tenants
+    with ThreadPoolExecutor(processes) as executor:
+        reports = list(executor.map(lambda name: run_isolated(name, timeout), tenants))
+
+    failed = [report for report in reports if not report["ok"]]
+    lines = [f"Synced {len(tenants) - len(failed)}/{len(tenants)} tenants in {time.perf_counter() - start:.1f}s"]
+    lines += [report_line(report) for report in reports]
+    for line in lines:
+        logging.info(line)
+    if failed:
+        NotificationManager.send_error_notification("Multi-tenant sync", "\n".join(lines), fatal=False)
+    else:
+        NotificationManager.send_info_notification("\n".join(lines))
+    NotificationManager.flush()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())